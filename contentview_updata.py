@@ -26,12 +26,26 @@
 
 
 import sys
+import os
 import subprocess
 import json
 import shlex
+import re
+import fnmatch
+import copy
+import contextlib
+import threading
+import concurrent.futures
 from functools import reduce
 import argparse
 import datetime
+import time
+import getpass
+import base64
+import gzip
+import ssl
+import http.client
+import urllib.parse
 
 
 
@@ -42,11 +56,363 @@ def union_of_all(*sets):
     return reduce(union_of_a_and_b, sets, set())
 
 
+# Parse a size like "512M", "20G" or "1.5TiB" to bytes (binary units).
+def parse_size(value):
+    match = re.match(r"^\s*([0-9]+(?:\.[0-9]*)?)\s*([kmgtp]?)(?:i?b)?\s*$", value, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError("invalid size: %s" % (value))
+    return int(float(match.group(1)) * 1024 ** " kmgtp".index(match.group(2).lower() or " "))
+
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if abs(size) < 1024 or unit == "TiB":
+            return ("%d %s" % (size, unit)) if unit == "B" else ("%.1f %s" % (size, unit))
+        size = size / 1024.0
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh %02dm" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm %02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % (seconds)
+
+
+# Call function(item) for every item, running at most jobs calls at the same time.
+#  Errors do not stop the other calls; they are reported per item and returned
+#  as a list of (item, exception). The calls are traced as steps of phase.
+def run_parallel(function, items, jobs, describe=str, phase=None):
+    failures = []
+    def run(item):
+        with trace("step", describe(item), phase=phase):
+            return function(item)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        run = in_current_organization(run)
+        futures = [(item, executor.submit(run, item)) for item in items]
+        try:
+            for (item, future) in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    print("%sFailed: %s: %s" % (organization_prefix(), describe(item), e), file=sys.stderr)
+                    failures.append((item, e))
+        except KeyboardInterrupt:
+            # Start nothing more; what is running is waited for.
+            for (item, future) in futures:
+                future.cancel()
+            raise
+    return failures
+
+
+# Run a graph of tasks, each as soon as the tasks it depends on have finished.
+#  tasks maps a key to a function without arguments, dependencies maps a key
+#  to the keys it depends on. At most jobs functions run at the same time.
+#  Tasks depending (directly or not) on a failed task are not run.
+#  Returns (results, failures, blocked): results maps keys to return values,
+#  failures is a list of (key, exception) and blocked a list of keys not run.
+#  With durations (estimated seconds per key), of the tasks ready to run those
+#  starting the longest chain of work are started first. The tasks are traced
+#  as steps of the phase given by phase(key).
+def run_task_graph(tasks, dependencies, jobs, describe=str, durations=None, phase=lambda key: None):
+    waiting_for = dict((key, set(dependencies.get(key, ()))) for key in tasks)
+    dependents = dict((key, []) for key in tasks)
+    for (key, deps) in waiting_for.items():
+        for dep in deps:
+            if dep not in tasks:
+                raise Exception("%s depends on unknown task %s" % (describe(key), describe(dep)))
+            dependents[dep].append(key)
+    results = {}
+    failures = []
+    blocked = []
+    def block(key):
+        if key in waiting_for:
+            del waiting_for[key]
+            blocked.append(key)
+            print("%sNot run: %s" % (organization_prefix(), describe(key)), file=sys.stderr)
+            for dependent in dependents[key]:
+                block(dependent)
+    def run(key):
+        with trace("step", describe(key), phase=phase(key)):
+            return tasks[key]()
+    priorities = critical_path_lengths(tasks, dependencies, durations) if durations else {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        running = {}
+        def start_ready():
+            for key in sorted([key for (key, deps) in waiting_for.items() if not deps], key=lambda key: -priorities.get(key, 0)):
+                del waiting_for[key]
+                running[executor.submit(in_current_organization(run), key)] = key
+        start_ready()
+        try:
+            while running:
+                (done, not_done) = concurrent.futures.wait(list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    key = running.pop(future)
+                    try:
+                        results[key] = future.result()
+                    except Exception as e:
+                        print("%sFailed: %s: %s" % (organization_prefix(), describe(key), e), file=sys.stderr)
+                        failures.append((key, e))
+                        for dependent in dependents[key]:
+                            block(dependent)
+                        continue
+                    for dependent in dependents[key]:
+                        if dependent in waiting_for:
+                            waiting_for[dependent].discard(key)
+                start_ready()
+        except KeyboardInterrupt:
+            # Start nothing more; what is running is waited for.
+            for future in running:
+                future.cancel()
+            raise
+    if waiting_for:
+        raise Exception("Dependency cycle between: %s" % (", ".join([describe(key) for key in waiting_for])))
+    return (results, failures, blocked)
+
+
+
+
+# For each task of a graph, the estimated seconds from its start until the
+# last task depending on it (directly or not) is done.
+#  durations maps keys to estimated seconds; missing keys take no time.
+def critical_path_lengths(tasks, dependencies, durations):
+    dependents = dict((key, []) for key in tasks)
+    for (key, deps) in dependencies.items():
+        for dep in deps:
+            if dep in dependents:
+                dependents[dep].append(key)
+    lengths = {}
+    def length(key, visiting):
+        if key not in lengths:
+            if key in visiting:
+                # A cycle; run_task_graph() reports it.
+                return 0
+            visiting.add(key)
+            lengths[key] = durations.get(key, 0) + max([length(dependent, visiting) for dependent in dependents[key]] + [0])
+            visiting.discard(key)
+        return lengths[key]
+    for key in tasks:
+        length(key, set())
+    return lengths
+
+
+# Estimated seconds to run operations taking durations seconds, at most jobs
+# at the same time, longest first.
+def estimate_makespan(durations, jobs):
+    workers = [0.0] * max(1, jobs)
+    for duration in sorted(durations, reverse=True):
+        workers[workers.index(min(workers))] += duration
+    return max(workers)
+
+
+# Read-through cache of hammer() results, kept for the duration of one run.
+#  Entries are tagged with the content views and versions named in their
+#  arguments, so that a write to a view or version invalidates exactly the
+#  entries about it.
+class HammerCache:
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+
+    # Content views named in hammer arguments, as ("id", id) and ("name", org, name),
+    # and content view versions, as ("version", id).
+    #  For "content-view version ..." commands --id is a version id, the view is
+    #  given by --content-view and --content-view-id.
+    @staticmethod
+    def tags(args):
+        (words, options) = parse_hammer_args(args)
+        if words[:1] != ("content-view",):
+            return set()
+        (name_option, id_option) = ("--content-view", "--content-view-id") if words[1:2] == ("version",) else ("--name", "--id")
+        tags = set()
+        if words[1:2] == ("version",) and "--id" in options:
+            tags.add(("version", options["--id"]))
+        if "--composite-version-id" in options:
+            tags.add(("version", options["--composite-version-id"]))
+        if id_option in options:
+            tags.add(("id", options[id_option]))
+        if name_option in options:
+            tags.add(("name", options.get("--organization-id"), options[name_option]))
+        return tags
+
+
+    # Returns (cached, data, generation); pass the generation on to put().
+    def get(self, args):
+        with self.lock:
+            if args in self.entries:
+                self.hits += 1
+                return (True, copy.deepcopy(self.entries[args][1]), self.generation)
+            self.misses += 1
+            return (False, None, self.generation)
+
+
+    # A result is not stored if a write happened while it was being read.
+    def put(self, args, data, generation):
+        with self.lock:
+            if generation == self.generation:
+                self.entries[args] = (self.tags(args), copy.deepcopy(data))
+
+
+    def invalidate(self, args):
+        tags = self.tags(args)
+        with self.lock:
+            self.generation += 1
+            for key in [key for (key, (entry_tags, data)) in self.entries.items() if entry_tags & tags]:
+                del self.entries[key]
+
+
+
+
+# What was done (or deliberately not done) during the run, by category.
+#  Printed at the end of the run.
+class RunSummary:
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+
+    def add(self, category, item):
+        with self.lock:
+            self.items.setdefault(category, []).append(item)
+
+
+    def print(self, file=sys.stdout):
+        for (category, items) in self.items.items():
+            print("%s (%d): %s" % (category, len(items), ", ".join(sorted(items))), file=file)
+
+
+# Timing of the operations of a run, for finding where the time goes.
+#  Each span records its category, name, start, duration, thread and
+#  arguments (like the view, bytes returned and outcome). Written as a Chrome
+#  trace, which chrome://tracing and ui.perfetto.dev can show.
+class Tracer:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.spans = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+
+
+    # Context manager timing the operation in its block.
+    #  The block can add arguments to the dict it gets. The outcome is "ok",
+    #  or the exception the block raised.
+    @contextlib.contextmanager
+    def span(self, category, name, args):
+        thread = threading.current_thread()
+        start = time.monotonic()
+        args["outcome"] = "ok"
+        try:
+            yield args
+        except BaseException as e:
+            args["outcome"] = "%s: %s" % (type(e).__name__, str(e).splitlines()[0] if str(e) else "")
+            raise
+        finally:
+            end = time.monotonic()
+            with self.lock:
+                self.thread_names[thread.ident] = thread.name
+                self.spans.append({"cat": category, "name": name, "start": start - self.start, "duration": end - start, "tid": thread.ident, "args": args})
+
+
+    def write(self, path):
+        pid = os.getpid()
+        with self.lock:
+            events = [{"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": name}} for (tid, name) in self.thread_names.items()]
+            events += [{
+                "ph": "X",
+                "cat": span["cat"],
+                "name": span["name"],
+                "ts": int(span["start"] * 1000000),
+                "dur": int(span["duration"] * 1000000),
+                "pid": pid,
+                "tid": span["tid"],
+                "args": span["args"]
+            } for span in self.spans]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+    def print_slowest(self, count=15, file=sys.stderr):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span["duration"], reverse=True)[0:count]
+        print("Slowest operations:", file=file)
+        for span in spans:
+            view = " (%s)" % (span["args"]["view"]) if span["args"].get("view") else ""
+            print("%10.3fs %-8s %s%s: %s" % (span["duration"], span["cat"], span["name"], view, span["args"]["outcome"]), file=file)
+
+
+# Time the block as a span of the run's tracer, if there is one.
+#  Yields the dict of span arguments, which the block can add to.
+@contextlib.contextmanager
+def trace(category, name, **args):
+    tracer = global_variables["tracer"]
+    if global_variables["multiple_organizations"]:
+        args["organization"] = current_organization().name
+    if tracer is None:
+        yield args
+        return
+    with tracer.span(category, name, args):
+        yield args
+
+
+# An organization and the state of the run for it: its read cache,
+# lifecycle environment graph, run summary, the environments promoted to and
+# the history of publish and promote durations.
+class Organization:
+    def __init__(self, organization_id, name=None):
+        self.id = str(organization_id)
+        self.name = name if name is not None else self.id
+        self.cache = HammerCache()
+        self.environment_graph = None
+        self.summary = RunSummary()
+        self.promoted_environments = set()
+        self.history = None
+
+
+# The organization the current thread works on.
+#  Functions run in other threads get it through in_current_organization().
+organization_context = threading.local()
+
+
+def current_organization():
+    return getattr(organization_context, "organization", global_variables["default_organization"])
+
+
+# Wrap function so that it runs in the organization of the calling thread.
+def in_current_organization(function):
+    organization = current_organization()
+    def run(*args, **kwargs):
+        previous = getattr(organization_context, "organization", None)
+        organization_context.organization = organization
+        try:
+            return function(*args, **kwargs)
+        finally:
+            organization_context.organization = previous
+    return run
+
+
+# Messages are prefixed with the organization when several are processed.
+def organization_prefix():
+    if global_variables["multiple_organizations"]:
+        return "[%s] " % (current_organization().name)
+    return ""
+
+
 
 
 global_variables = {
     "verbose_level": 0,
-    "allow_updates": True
+    "allow_updates": True,
+    "api": None,
+    "task_poller": None,
+    "limiter": None,
+    "tracer": None,
+    "default_organization": Organization("1"),
+    "multiple_organizations": False
 }
 
 
@@ -58,13 +424,72 @@ def set_dry_run():
     global_variables["allow_updates"] = False
 
 
-def verbose_print(levels, *args, **kwargs):
-    if global_variables["verbose_level"] in levels:
-        print(*args, **kwargs)
+def set_api(api):
+    global_variables["api"] = api
+
+
+def set_task_poller(task_poller):
+    global_variables["task_poller"] = task_poller
+
+
+def set_limiter(limiter):
+    global_variables["limiter"] = limiter
+
+
+def set_tracer(tracer):
+    global_variables["tracer"] = tracer
+
 
+print_lock = threading.Lock()
 
-def hammer(*args, updates=True):
-    commandline = ["hammer"] + ("--verbose" if global_variables["verbose_level"] in [2] else []) + ["--output", "json"]+ list(args)
+
+def verbose_print(levels, *args, **kwargs):
+    if global_variables["verbose_level"] in levels:
+        prefix = organization_prefix()
+        if prefix and args:
+            args = (prefix + str(args[0]),) + args[1:]
+        with print_lock:
+            print(*args, **kwargs)
+
+
+def hammer(*args, updates=True, cached=True):
+    cache = current_organization().cache
+    if not updates and not cached:
+        return run_hammer(*args, updates=updates)
+    if not updates:
+        (cached, data, generation) = cache.get(args)
+        if cached:
+            verbose_print([2], "Cached result for: %s" % (" ".join([shlex.quote(str(s)) for s in args])), file=sys.stderr)
+            return data
+        data = run_hammer(*args, updates=updates)
+        cache.put(args, data, generation)
+        return data
+    try:
+        return run_hammer(*args, updates=updates)
+    finally:
+        cache.invalidate(args)
+
+
+# Number of items fetched per call by hammer_pages.
+PAGE_SIZE = 100
+
+
+# Iterate over the items of a hammer list command one page at a time.
+#  Pages are fetched (and cached) as the caller gets to them, so a caller that
+#  stops early does not fetch the remaining pages.
+def hammer_pages(*args, per_page=PAGE_SIZE, cached=True):
+    page = 1
+    while True:
+        items = hammer(*(args + ("--page", str(page), "--per-page", str(per_page))), updates=False, cached=cached) or []
+        for item in items:
+            yield item
+        if len(items) < per_page:
+            return
+        page += 1
+
+
+def run_hammer(*args, updates=True):
+    commandline = ["hammer"] + (["--verbose"] if global_variables["verbose_level"] in [2] else []) + ["--output", "json"]+ list(args)
     commandlinestring = " ".join([shlex.quote(str(s)) for s in commandline])
 
 
@@ -80,29 +505,849 @@ def hammer(*args, updates=True):
         assert(isinstance(arg, str))
 
 
-    completed = subprocess.run(commandline, stdout=subprocess.PIPE)
-    # (Modify completed.args here if secrets were sent on the commandline.)
-    completed.check_returncode()
+    (words, options) = parse_hammer_args(args)
+    with trace("hammer", " ".join(words), command=commandlinestring, view=hammer_view_name(options)) as span:
+        if global_variables["api"] is not None:
+            # Same command, answered in-process over the REST API.
+            data = global_variables["api"].hammer(*args)
+            span["bytes"] = global_variables["api"].bytes_read()
+            verbose_print([2], "API result:\n%s" % (json.dumps(data, indent=2)), file=sys.stderr)
+            verbose_print([1], "API call successful.", file=sys.stderr)
+            return data
+
+
+        completed = subprocess.run(commandline, stdout=subprocess.PIPE)
+        span["bytes"] = len(completed.stdout)
+        # (Modify completed.args here if secrets were sent on the commandline.)
+        completed.check_returncode()
+
+
+        jsondata = completed.stdout.decode("utf8")
+        if len(jsondata) > 0:
+            verbose_print([2], "Command result:\n%s" % (jsondata), file=sys.stderr)
+            verbose_print([1], "Command successful, returned JSON data.", file=sys.stderr)
+            return json.loads(jsondata)
+        verbose_print([1,2], "Command successful, returned no data.", file=sys.stderr)
+        return None
+
+
+# The content view a hammer command is about, for tracing; None if not known.
+def hammer_view_name(options):
+    return options.get("--content-view") or (options.get("--name") if options.get("--content-view-id") is None else None)
+
+
+
+
+# Run a hammer command which starts a foreman task, and wait for the task.
+#  Without a task poller hammer itself waits. With one, the command is started
+#  with --async and the poller reports when the task has stopped, so that a
+#  waiting operation does not hold on to a hammer process (or connection).
+#  Raises subprocess.CalledProcessError if the task did not succeed.
+#  A timeout (in seconds) needs a task poller; without one hammer waits as long as it takes.
+#  With duration_key, (operation, content_view_name), the time the task took is
+#  recorded in the duration history.
+def hammer_task(*args, timeout=None, duration_key=None):
+    (words, options) = parse_hammer_args(args)
+    with trace("task", " ".join(words), view=hammer_view_name(options)):
+        limiter = global_variables["limiter"]
+        if limiter is None:
+            return run_hammer_task(*args, timeout=timeout, duration_key=duration_key)
+        with limiter:
+            return run_hammer_task(*args, timeout=timeout, duration_key=duration_key)
+
+
+def run_hammer_task(*args, timeout=None, duration_key=None):
+    start = time.monotonic()
+    task = wait_hammer_task(*args, timeout=timeout)
+    if duration_key is not None and current_organization().history is not None:
+        current_organization().history.record(duration_key[0], duration_key[1], time.monotonic() - start)
+    return task
+
+
+def wait_hammer_task(*args, timeout=None):
+    task_poller = global_variables["task_poller"]
+    if task_poller is None:
+        return hammer(*args)
+    data = hammer(*args, "--async")
+    task_id = get_task_id(data)
+    if task_id is None:
+        raise Exception("No task id in the result of: hammer %s" % (" ".join(args)))
+    try:
+        task = task_poller.wait(task_id, timeout=timeout)
+    finally:
+        # The task changed (or may still change) the view after the command returned.
+        current_organization().cache.invalidate(args)
+    if task["Result"] not in ["success", "warning"]:
+        raise subprocess.CalledProcessError(1, ["hammer"] + list(args), output="Task %s %s: %s" % (task_id, task["Result"], task.get("Task errors") or ""))
+    return task
+
+
+# Find the task id in the output of a hammer command run with --async.
+def get_task_id(data):
+    if isinstance(data, dict):
+        if data.get("id") is not None:
+            return str(data["id"])
+        match = re.search(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", data.get("message") or "")
+        if match:
+            return match.group(0)
+    return None
 
 
-    jsondata = completed.stdout.decode("utf8")
-    if len(jsondata) > 0:
-        verbose_print([2], "Command result:\n%s" % (jsondata), file=sys.stderr)
-        verbose_print([1], "Command successful, returned JSON data.", file=sys.stderr)
-        return json.loads(jsondata)
-    verbose_print([1,2], "Command successful, returned no data.", file=sys.stderr)
-    return None
+# Waits for any number of foreman tasks, asking for the state of all of them
+# in one "task list" call every interval seconds.
+#  Gives up on all tasks after max_failures failed polls in a row (like when
+#  the hammer session has expired), and on a task that is missing from
+#  max_missing answers in a row.
+class TaskPoller:
+    def __init__(self, interval=5.0, batch_size=100, max_failures=10, max_missing=10):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_failures = max_failures
+        self.max_missing = max_missing
+        self.callbacks = {}
+        self.missing = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+
+    # Call callback(task, None) when the task has stopped, or
+    # callback(None, error) when giving up on it.
+    def add(self, task_id, callback):
+        with self.lock:
+            self.callbacks[task_id] = callback
+            self.missing[task_id] = 0
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="task-poller", daemon=True)
+                self.thread.start()
+
+
+    # Block until the task has stopped, and return its "task list" data.
+    #  Raises an exception if it has not stopped within timeout seconds (the
+    #  task goes on), or if the poller gave up on it. The task is looked at once
+    #  more when the timeout is up, as it may have stopped since the last poll.
+    def wait(self, task_id, timeout=None):
+        stopped = threading.Event()
+        results = []
+        def callback(task, error):
+            results.append((task, error))
+            stopped.set()
+        self.add(task_id, callback)
+        if not stopped.wait(timeout):
+            with self.lock:
+                self.callbacks.pop(task_id, None)
+                self.missing.pop(task_id, None)
+            if not results:
+                tasks = hammer("task", "list", "--search", "id ^ (%s)" % (task_id), "--per-page", "1", updates=False, cached=False) or []
+                tasks = [task for task in tasks if task["ID"] == task_id and task["State"] in ["stopped", "paused"]]
+                if not tasks:
+                    raise Exception("Task %s still running after %g seconds" % (task_id, timeout))
+                return tasks[0]
+        (task, error) = results[0]
+        if error is not None:
+            raise error
+        return task
+
+
+    # Stop waiting for the tasks, calling their callbacks with error.
+    def give_up(self, task_ids, error):
+        for task_id in task_ids:
+            with self.lock:
+                callback = self.callbacks.pop(task_id, None)
+                self.missing.pop(task_id, None)
+            if callback is not None:
+                callback(None, error)
+
+
+    def run(self):
+        failures = 0
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                task_ids = list(self.callbacks)
+            for i in range(0, len(task_ids), self.batch_size):
+                batch = task_ids[i:i + self.batch_size]
+                try:
+                    tasks = hammer("task", "list", "--search", "id ^ (%s)" % (", ".join(batch)), "--per-page", str(len(batch)), updates=False, cached=False)
+                except Exception as e:
+                    failures += 1
+                    if failures >= self.max_failures:
+                        print("Polling tasks failed %d times in a row, giving up: %s" % (failures, e), file=sys.stderr)
+                        with self.lock:
+                            task_ids = list(self.callbacks)
+                        self.give_up(task_ids, Exception("Polling tasks failed %d times in a row: %s" % (failures, e)))
+                        failures = 0
+                        break
+                    print("Polling tasks failed, will retry: %s" % (e), file=sys.stderr)
+                    continue
+                failures = 0
+                found = set()
+                for task in tasks or []:
+                    found.add(task["ID"])
+                    if task["State"] in ["stopped", "paused"]:
+                        with self.lock:
+                            callback = self.callbacks.pop(task["ID"], None)
+                            self.missing.pop(task["ID"], None)
+                        if callback is not None:
+                            callback(task, None)
+                lost = []
+                with self.lock:
+                    for task_id in batch:
+                        if task_id not in found and task_id in self.missing:
+                            self.missing[task_id] += 1
+                            if self.missing[task_id] >= self.max_missing:
+                                lost.append(task_id)
+                for task_id in lost:
+                    self.give_up([task_id], Exception("Task %s not found in %d task lists in a row" % (task_id, self.max_missing)))
+
+
+
+
+# Limits how many tasks this script has running, between floor and ceiling,
+# depending on how busy the foreman task system is.
+#  Every interval seconds the running and pending tasks (of all users) are counted.
+#  The limit is halved when more than high are queued, and raised by one when
+#  fewer than low are.
+class AdaptiveLimiter:
+    def __init__(self, floor, ceiling, high=20, low=5, interval=30.0):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.high = high
+        self.low = low
+        self.interval = interval
+        self.limit = max(self.floor, (self.ceiling + 1) // 2)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+
+    def __enter__(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="adaptive-limiter", daemon=True)
+                self.thread.start()
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+    # Number of running and pending tasks; counting stops above high.
+    def backlog(self):
+        tasks = hammer("task", "list", "--search", "state ^ (planning, planned, running)", "--per-page", str(self.high + 1), updates=False, cached=False)
+        return len(tasks or [])
+
+
+    def adjust(self, backlog):
+        with self.condition:
+            if backlog > self.high:
+                limit = max(self.floor, self.limit // 2)
+            elif backlog < self.low:
+                limit = min(self.ceiling, self.limit + 1)
+            else:
+                limit = self.limit
+            if limit != self.limit:
+                verbose_print([1,2], "Task backlog %d: running at most %d tasks (was %d)." % (backlog, limit, self.limit), file=sys.stderr)
+                self.limit = limit
+                self.condition.notify_all()
+
+
+    def run(self):
+        while True:
+            try:
+                self.adjust(self.backlog())
+            except Exception as e:
+                print("Counting running tasks failed, will retry: %s" % (e), file=sys.stderr)
+            time.sleep(self.interval)
+
+
+
+
+# Split hammer style arguments into the subcommand words and a dict of options.
+#  Options always take a value, except for the flags listed.
+def parse_hammer_args(args, flags=("--async",)):
+    words = []
+    options = {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in flags:
+            options[arg] = True
+            i += 1
+        elif arg.startswith("--"):
+            options[arg] = args[i + 1]
+            i += 2
+        else:
+            words.append(arg)
+            i += 1
+    return (tuple(words), options)
+
+
+# Minimal Foreman/Katello REST client.
+#  It answers the hammer commands used by this script in-process and returns
+#  data shaped like "hammer --output json" would, so that hammer() can use it
+#  instead of starting a new hammer process (and TLS session) for every call.
+#  Failures are raised as subprocess.CalledProcessError, like for hammer.
+class ForemanAPI:
+    def __init__(self, server, username, password, cafile=None, timeout=300, poll_interval=2.0):
+        url = urllib.parse.urlsplit(server if "://" in server else "https://" + server)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.context = ssl.create_default_context(cafile=cafile) if self.scheme == "https" else None
+        auth_string = "%s:%s" % (username, password)
+        self.headers = {
+            "Authorization": "Basic %s" % base64.b64encode(auth_string.encode("utf-8")).decode(),
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Connection": "keep-alive"
+        }
+        self.local = threading.local()
+        self.content_view_ids = {}
+        self.environment_ids = {}
+        self.commands = {
+            ("auth", "status"): self.auth_status,
+            ("lifecycle-environment", "list"): self.lifecycle_environment_list,
+            ("content-view", "list"): self.content_view_list,
+            ("content-view", "info"): self.content_view_info,
+            ("content-view", "publish"): self.content_view_publish,
+            ("content-view", "update"): self.content_view_update,
+            ("content-view", "version", "list"): self.content_view_version_list,
+            ("content-view", "version", "promote"): self.content_view_version_promote,
+            ("content-view", "version", "delete"): self.content_view_version_delete,
+            ("content-view", "version", "info"): self.content_view_version_info,
+            ("repository", "info"): self.repository_info,
+            ("organization", "list"): self.organization_list,
+            ("task", "list"): self.task_list,
+            ("capsule", "list"): self.capsule_list,
+            ("capsule", "content", "lifecycle-environments"): self.capsule_content_lifecycle_environments,
+            ("capsule", "content", "synchronize"): self.capsule_content_synchronize
+        }
+
+
+    def connect(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+
+    # Make one request on the kept-alive connection and return the decoded JSON.
+    #  Each thread keeps its own connection. A connection closed by the server
+    #  while idle is reopened, and GET requests are retried once on the new
+    #  connection. Like hammer, raises subprocess.CalledProcessError on failure,
+    #  also when the server cannot be reached.
+    def request(self, method, path, params=None, data=None, command=None):
+        if params:
+            path = path + "?" + urllib.parse.urlencode(params)
+        body = json.dumps(data).encode("utf8") if data is not None else None
+        for attempt in [1, 2]:
+            connection = getattr(self.local, "connection", None)
+            reused = connection is not None
+            if not reused:
+                connection = self.local.connection = self.connect()
+            try:
+                connection.request(method, path, body=body, headers=self.headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                self.local.connection = None
+                if reused and method == "GET" and isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)):
+                    continue
+                raise subprocess.CalledProcessError(1, command or [method, path], output="%s %s: %s" % (method, path, e))
+            break
+        self.local.bytes_read = getattr(self.local, "bytes_read", 0) + len(content)
+        if response.status >= 400:
+            raise subprocess.CalledProcessError(response.status, command or [method, path], output=content)
+        if len(content) == 0:
+            return None
+        return json.loads(content.decode("utf8"))
+
+
+    # Fetch every page of an index call, or only the page asked for with --page.
+    #  Pages are fetched until one is short (the server may give fewer per page
+    #  than asked for, and says so), or the subtotal is reached if there is one.
+    def get_all(self, path, params, command=None, per_page=100, options={}):
+        if "--page" in options:
+            data = self.request("GET", path, dict(params, page=options["--page"], per_page=options.get("--per-page", per_page)), command=command)
+            return data["results"]
+        results = []
+        page = 1
+        while True:
+            data = self.request("GET", path, dict(params, page=page, per_page=per_page), command=command)
+            results.extend(data["results"])
+            if len(data["results"]) < int(data.get("per_page") or per_page):
+                return results
+            if data.get("subtotal") is not None and len(results) >= int(data["subtotal"]):
+                return results
+            page += 1
+
+
+    # Wait until a foreman task has stopped; fail like hammer does if it did not succeed.
+    #  With --async, return at once like hammer does.
+    def wait_for_task(self, task, options, command=None):
+        if options.get("--async"):
+            return task
+        while task["state"] not in ["stopped", "paused"]:
+            time.sleep(self.poll_interval)
+            task = self.request("GET", "/foreman_tasks/api/tasks/%s" % task["id"], command=command)
+        if task["result"] not in ["success", "warning"]:
+            raise subprocess.CalledProcessError(1, command or task["id"], output="Task %s %s: %s" % (task["id"], task["result"], "; ".join(task.get("humanized", {}).get("errors") or [])))
+        return task
+
+
+    # Bytes received by the calling thread for its last hammer command.
+    def bytes_read(self):
+        return getattr(self.local, "bytes_read", 0)
+
+
+    def hammer(self, *args):
+        self.local.bytes_read = 0
+        (words, options) = parse_hammer_args(args)
+        if words not in self.commands:
+            raise Exception("Command not supported by the API client: %s" % (" ".join(words)))
+        return self.commands[words](options, ["hammer"] + list(args))
+
+
+    def auth_status(self, options, command):
+        user = self.request("GET", "/api/current_user", command=command)
+        return {"message": "Session exists, currently logged in as '%s'." % (user["login"])}
+
+
+    def organization_list(self, options, command):
+        organizations = self.get_all("/katello/api/organizations", {}, command=command)
+        return [{
+            "ID": organization["id"],
+            "Name": organization["name"],
+            "Label": organization.get("label")
+        } for organization in organizations]
+
+
+    def lifecycle_environment_list(self, options, command):
+        envs = self.get_all("/katello/api/organizations/%s/environments" % options["--organization-id"], {}, command=command)
+        return [{
+            "ID": env["id"],
+            "Name": env["name"],
+            "Label": env["label"],
+            "Prior": env["prior"]["name"] if env.get("prior") else None
+        } for env in envs]
+
+
+    def environment_id(self, organization_id, name, command):
+        key = (organization_id, name)
+        if key not in self.environment_ids:
+            for env in self.lifecycle_environment_list({"--organization-id": organization_id}, command):
+                self.environment_ids[(organization_id, env["Name"])] = env["ID"]
+        if key not in self.environment_ids:
+            raise subprocess.CalledProcessError(65, command, output="Lifecycle environment %s not found" % (name))
+        return self.environment_ids[key]
+
+
+    # Content view ids do not change, so name lookups are only made once.
+    def content_view_id(self, options, command, name_option="--name", id_option="--id"):
+        if options.get(id_option) is not None:
+            return options[id_option]
+        key = (options["--organization-id"], options[name_option])
+        if key not in self.content_view_ids:
+            views = self.get_all("/katello/api/content_views", {"organization_id": key[0], "name": key[1]}, command=command)
+            for view in views:
+                if view["name"] == key[1]:
+                    self.content_view_ids[key] = str(view["id"])
+        if key not in self.content_view_ids:
+            raise subprocess.CalledProcessError(65, command, output="Content view %s not found" % (key[1]))
+        return self.content_view_ids[key]
+
+
+    def content_view_list(self, options, command):
+        params = {"organization_id": options["--organization-id"]}
+        if "--composite" in options:
+            params["composite"] = options["--composite"]
+        views = self.get_all("/katello/api/content_views", params, command=command, options=options)
+        return [{
+            "Content View ID": view["id"],
+            "Name": view["name"],
+            "Label": view["label"],
+            "Composite": view["composite"],
+            "Last Published": view.get("last_published"),
+            "Repository IDs": ", ".join([str(repository_id) for repository_id in view.get("repository_ids") or []])
+        } for view in views]
+
+
+    def content_view_info(self, options, command):
+        view = self.request("GET", "/katello/api/content_views/%s" % self.content_view_id(options, command), command=command)
+        def collection(items):
+            return dict((str(i + 1), item) for (i, item) in enumerate(items))
+        return {
+            "ID": view["id"],
+            "Name": view["name"],
+            "Label": view["label"],
+            "Composite": view["composite"],
+            "Description": view.get("description"),
+            "Components": collection([{
+                "ID": component["id"],
+                "Name": "%s %s" % (component["content_view"]["name"], component["version"])
+            } for component in view.get("components") or []]),
+            "Yum Repositories": collection([{
+                "ID": repository["id"],
+                "Name": repository["name"],
+                "Label": repository.get("label")
+            } for repository in view.get("repositories") or []])
+        }
+
+
+    def content_view_publish(self, options, command):
+        view_id = self.content_view_id(options, command)
+        task = self.request("POST", "/katello/api/content_views/%s/publish" % view_id, data={"description": options.get("--description", "")}, command=command)
+        self.wait_for_task(task, options, command=command)
+        return {"message": "Content view is being published with task %s." % (task["id"]), "id": task["id"]}
+
+
+    # Only the component versions of composite views are updated.
+    def content_view_update(self, options, command):
+        view_id = self.content_view_id(options, command)
+        data = {}
+        if "--component-ids" in options:
+            data["component_ids"] = [int(component_id) for component_id in options["--component-ids"].split(",") if component_id]
+        self.request("PUT", "/katello/api/content_views/%s" % view_id, data=data, command=command)
+        return {"message": "Content view updated."}
+
+
+    def content_view_version_list(self, options, command):
+        if "--composite-version-id" in options:
+            params = {"composite_version_id": options["--composite-version-id"]}
+        else:
+            params = {"content_view_id": self.content_view_id(options, command, name_option="--content-view", id_option="--content-view-id")}
+        versions = self.get_all("/katello/api/content_view_versions", params, command=command, options=options)
+        return [{
+            "ID": version["id"],
+            "Name": version["name"],
+            "Version": version["version"],
+            "Description": version.get("description"),
+            "Lifecycle Environments": [env["name"] for env in version.get("environments") or []]
+        } for version in versions]
+
+
+    def content_view_version_info(self, options, command):
+        version = self.request("GET", "/katello/api/content_view_versions/%s" % options["--id"], command=command)
+        return {
+            "ID": version["id"],
+            "Name": version["name"],
+            "Version": version["version"],
+            "Description": version.get("description"),
+            "Created": version.get("created_at"),
+            "Packages": version.get("package_count"),
+            "Lifecycle Environments": [env["name"] for env in version.get("environments") or []]
+        }
+
+
+    def repository_info(self, options, command):
+        repository = self.request("GET", "/katello/api/repositories/%s" % options["--id"], command=command)
+        last_sync = repository.get("last_sync") or {}
+        return {
+            "ID": repository["id"],
+            "Name": repository["name"],
+            "Label": repository.get("label"),
+            "Updated": repository.get("updated_at"),
+            "Content Last Updated": repository.get("content_last_updated"),
+            "Sync": {
+                "Status": last_sync.get("result"),
+                "Last Sync Date": last_sync.get("ended_at")
+            }
+        }
+
+
+    def content_view_version_promote(self, options, command):
+        if "--id" in options:
+            version_id = options["--id"]
+        else:
+            fromenv = options["--from-lifecycle-environment"]
+            versions = [version for version in self.content_view_version_list(options, command) if fromenv in version["Lifecycle Environments"]]
+            if not versions:
+                raise subprocess.CalledProcessError(65, command, output="No version of %s in %s" % (options["--content-view"], fromenv))
+            version_id = versions[0]["ID"]
+        data = {
+            "environment_ids": [self.environment_id(options["--organization-id"], options["--to-lifecycle-environment"], command)],
+            "description": options.get("--description", ""),
+            "force_yum_metadata_regeneration": options.get("--force-yum-metadata-regeneration") == "true"
+        }
+        task = self.request("POST", "/katello/api/content_view_versions/%s/promote" % version_id, data=data, command=command)
+        self.wait_for_task(task, options, command=command)
+        return {"message": "Content view is being promoted with task %s." % (task["id"]), "id": task["id"]}
+
+
+    def content_view_version_delete(self, options, command):
+        task = self.request("DELETE", "/katello/api/content_view_versions/%s" % options["--id"], command=command)
+        self.wait_for_task(task, options, command=command)
+        return {"message": "Content view version is being deleted with task %s." % (task["id"]), "id": task["id"]}
+
+
+    def capsule_list(self, options, command):
+        params = {"organization_id": options["--organization-id"]} if "--organization-id" in options else {}
+        capsules = self.get_all("/katello/api/capsules", params, command=command)
+        return [{
+            "ID": capsule["id"],
+            "Name": capsule["name"],
+            "URL": capsule.get("url"),
+            "Features": ", ".join([feature["name"] if isinstance(feature, dict) else feature for feature in capsule.get("features") or []])
+        } for capsule in capsules]
+
+
+    def capsule_content_lifecycle_environments(self, options, command):
+        params = {"organization_id": options["--organization-id"]} if "--organization-id" in options else {}
+        environments = self.get_all("/katello/api/capsules/%s/content/lifecycle_environments" % options["--id"], params, command=command)
+        return [{
+            "ID": environment["id"],
+            "Name": environment["name"],
+            "Organization": (environment.get("organization") or {}).get("name")
+        } for environment in environments]
+
+
+    def capsule_content_synchronize(self, options, command):
+        data = {}
+        if "--lifecycle-environment-id" in options:
+            data["environment_id"] = int(options["--lifecycle-environment-id"])
+        task = self.request("POST", "/katello/api/capsules/%s/content/sync" % options["--id"], data=data, command=command)
+        self.wait_for_task(task, options, command=command)
+        return {"message": "Capsule content is being synchronized with task %s." % (task["id"]), "id": task["id"]}
+
+
+    def task_list(self, options, command):
+        params = {"search": options.get("--search", ""), "per_page": options.get("--per-page", "20"), "page": options.get("--page", "1")}
+        tasks = self.request("GET", "/foreman_tasks/api/tasks", params, command=command)["results"]
+        return [{
+            "ID": task["id"],
+            "Action": task.get("action") or task.get("label"),
+            "State": task["state"],
+            "Result": task["result"],
+            "Started At": task.get("started_at"),
+            "Ended At": task.get("ended_at"),
+            "Input": task.get("input"),
+            "Task errors": "; ".join(task.get("humanized", {}).get("errors") or [])
+        } for task in tasks]
+
+
+
+
+# Version of the snapshot file format written by the snapshot command.
+SNAPSHOT_FORMAT = 1
+
+
+def open_snapshot(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf8")
+    return open(path, mode, encoding="utf8")
+
+
+# Answers the hammer commands used by this script from a snapshot file, offline.
+#  Changes (publish, promote, component updates and deletes) are applied to the
+#  snapshot in memory only and recorded as the plan; their tasks finish at once.
+#  Like ForemanAPI, data is shaped like "hammer --output json" would return it.
+class SnapshotAPI:
+    def __init__(self, path):
+        with open_snapshot(path, "r") as f:
+            snapshot = json.load(f)
+        if snapshot.get("format") != SNAPSHOT_FORMAT:
+            raise Exception("%s: unknown snapshot format %s" % (path, snapshot.get("format")))
+        self.path = path
+        self.created = snapshot["created"]
+        self.organization = snapshot["organization"]
+        self.environments = snapshot["environments"]
+        self.views = snapshot["views"]
+        self.versions = snapshot["versions"]
+        self.repositories = snapshot["repositories"]
+        self.version_views = dict((str(version["ID"]), view) for view in self.views for version in view["versions"])
+        self.next_version_id = max([int(version_id) for version_id in self.version_views] + [0]) + 1
+        self.next_task_id = 1
+        self.plan = []
+        self.lock = threading.Lock()
+        self.commands = {
+            ("auth", "status"): self.auth_status,
+            ("organization", "list"): self.organization_list,
+            ("lifecycle-environment", "list"): self.lifecycle_environment_list,
+            ("content-view", "list"): self.content_view_list,
+            ("content-view", "info"): self.content_view_info,
+            ("content-view", "publish"): self.content_view_publish,
+            ("content-view", "update"): self.content_view_update,
+            ("content-view", "version", "list"): self.content_view_version_list,
+            ("content-view", "version", "info"): self.content_view_version_info,
+            ("content-view", "version", "promote"): self.content_view_version_promote,
+            ("content-view", "version", "delete"): self.content_view_version_delete,
+            ("repository", "info"): self.repository_info,
+            ("task", "list"): self.task_list
+        }
+
+
+    def bytes_read(self):
+        return 0
+
+
+    def hammer(self, *args):
+        (words, options) = parse_hammer_args(args)
+        if words not in self.commands:
+            raise Exception("Command not supported with a snapshot: %s" % (" ".join(words)))
+        with self.lock:
+            return copy.deepcopy(self.commands[words](options, ["hammer"] + list(args)))
+
+
+    @staticmethod
+    def page(items, options):
+        if "--page" not in options:
+            return items
+        per_page = int(options.get("--per-page", "20"))
+        start = (int(options["--page"]) - 1) * per_page
+        return items[start:start + per_page]
+
+
+    def view(self, options, command, name_option="--name", id_option="--id"):
+        for view in self.views:
+            if id_option in options and str(view["list"]["Content View ID"]) != options[id_option]:
+                continue
+            if name_option in options and view["list"]["Name"] != options[name_option]:
+                continue
+            return view
+        raise subprocess.CalledProcessError(65, command, output="Content view not found in snapshot %s" % (self.path))
+
+
+    def version(self, version_id, command):
+        if str(version_id) not in self.versions:
+            raise subprocess.CalledProcessError(65, command, output="Content view version %s not found in snapshot %s" % (version_id, self.path))
+        return self.versions[str(version_id)]
+
+
+    def task(self, message, command):
+        task_id = "snapshot-%d" % (self.next_task_id)
+        self.next_task_id += 1
+        self.plan.append(" ".join([shlex.quote(arg) for arg in command]))
+        return {"message": "%s with task %s." % (message, task_id), "id": task_id}
+
+
+    # Move an environment to one version of a view.
+    def set_environment(self, view, version_id, environment):
+        for version in view["versions"]:
+            for data in [version, self.versions.get(str(version["ID"])) or {}]:
+                environments = [env for env in data.get("Lifecycle Environments") or [] if env != environment]
+                if str(version["ID"]) == str(version_id):
+                    environments.append(environment)
+                data["Lifecycle Environments"] = environments
+
+
+    def auth_status(self, options, command):
+        return {"message": "Session exists, using snapshot %s taken %s." % (self.path, self.created)}
+
+
+    def organization_list(self, options, command):
+        return [self.organization]
+
+
+    def lifecycle_environment_list(self, options, command):
+        return self.environments
+
+
+    def content_view_list(self, options, command):
+        views = [view["list"] for view in self.views]
+        if "--composite" in options:
+            views = [view for view in views if bool(view["Composite"]) == (options["--composite"] == "true")]
+        return self.page(views, options)
+
+
+    def content_view_info(self, options, command):
+        return self.view(options, command)["info"]
 
 
+    def content_view_version_list(self, options, command):
+        if "--composite-version-id" in options:
+            return self.page(self.version(options["--composite-version-id"], command).get("Components") or [], options)
+        return self.page(self.view(options, command, name_option="--content-view", id_option="--content-view-id")["versions"], options)
+
+
+    def content_view_version_info(self, options, command):
+        return self.version(options["--id"], command)
+
+
+    def repository_info(self, options, command):
+        if options["--id"] not in self.repositories:
+            raise subprocess.CalledProcessError(65, command, output="Repository %s not found in snapshot %s" % (options["--id"], self.path))
+        return self.repositories[options["--id"]]
+
+
+    # Tasks of this run have finished; nothing else runs.
+    def task_list(self, options, command):
+        match = re.match(r"id \^ \((.*)\)$", options.get("--search", ""))
+        if not match:
+            return []
+        return [{"ID": task_id, "State": "stopped", "Result": "success"} for task_id in match.group(1).split(", ")]
+
+
+    # A new version in Library, with as many packages as the latest one.
+    def content_view_publish(self, options, command):
+        view = self.view(options, command)
+        latest = {}
+        if view["versions"]:
+            latest = self.versions.get(str(view["versions"][0]["ID"])) or {}
+        version_id = self.next_version_id
+        self.next_version_id += 1
+        version = "%d.0" % (max([int(version["Version"].split(".")[0]) for version in view["versions"]] + [0]) + 1)
+        listed = {"ID": version_id, "Name": "%s %s" % (view["list"]["Name"], version), "Version": version, "Description": options.get("--description"), "Lifecycle Environments": []}
+        view["versions"].insert(0, listed)
+        self.versions[str(version_id)] = dict(listed, Created=datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC"), Packages=latest.get("Packages"), Size=latest.get("Size"))
+        if view["list"]["Composite"]:
+            components = view["info"].get("Components") or {}
+            self.versions[str(version_id)]["Components"] = list(components.values()) if isinstance(components, dict) else list(components)
+        self.version_views[str(version_id)] = view
+        self.set_environment(view, version_id, "Library")
+        return self.task("Content view is being published", command)
+
+
+    def content_view_update(self, options, command):
+        view = self.view(options, command)
+        components = {}
+        for component_version_id in [component_version_id for component_version_id in options.get("--component-ids", "").split(",") if component_version_id]:
+            component_view = self.version_views[component_version_id]
+            version = self.version(component_version_id, command)
+            components[str(len(components) + 1)] = {"ID": int(component_version_id), "Name": "%s %s" % (component_view["list"]["Name"], version["Version"])}
+        view["info"]["Components"] = components
+        self.plan.append(" ".join([shlex.quote(arg) for arg in command]))
+        return {"message": "Content view updated."}
+
+
+    def content_view_version_promote(self, options, command):
+        view = self.view(options, command, name_option="--content-view", id_option="--content-view-id")
+        if "--id" in options:
+            version_id = options["--id"]
+        else:
+            versions = [version for version in view["versions"] if options["--from-lifecycle-environment"] in version["Lifecycle Environments"]]
+            if not versions:
+                raise subprocess.CalledProcessError(65, command, output="No version of %s in %s" % (options["--content-view"], options["--from-lifecycle-environment"]))
+            version_id = versions[0]["ID"]
+        if options["--to-lifecycle-environment"] not in [env["Name"] for env in self.environments]:
+            raise subprocess.CalledProcessError(65, command, output="Lifecycle environment %s not found in snapshot %s" % (options["--to-lifecycle-environment"], self.path))
+        self.set_environment(view, version_id, options["--to-lifecycle-environment"])
+        return self.task("Content view is being promoted", command)
+
+
+    def content_view_version_delete(self, options, command):
+        self.version(options["--id"], command)
+        view = self.version_views[options["--id"]]
+        view["versions"] = [version for version in view["versions"] if str(version["ID"]) != options["--id"]]
+        del self.versions[options["--id"]]
+        return self.task("Content view version is being deleted", command)
 
 
 
 
 # Fail if not currently authenticated.
 #  This does not ensure that the session is still valid (not expired).
+#  Hammer can log in with a session (hammer auth login) or with the username
+#  and password configured in ~/.hammer/cli.modules.d/foreman.yml.
 def ensure_auth_session():
     authstatus = hammer("auth", "status", updates=False)
-    if 'message' not in authstatus or 'Session exists' not in authstatus['message']:
+    if 'message' not in authstatus or ('Session exists' not in authstatus['message'] and 'Using configured credentials' not in authstatus['message']):
         raise Exception("Login required: hammer auth login --help")
 
 
@@ -111,32 +1356,73 @@ def ensure_auth_session():
 # Get all data about a content view.
 #  the view must match the view id
 def get_lifecycle_environment_data():
-    return hammer("lifecycle-environment", "list", "--organization-id", "1", updates=False)
+    return hammer("lifecycle-environment", "list", "--organization-id", current_organization().id, updates=False)
+
+
+# The lifecycle environments of an organization, indexed by name, with
+# their prior (parent) and next (children) environments.
+#  Raises an exception if an environment has an unknown prior or if priors form a cycle.
+class EnvironmentGraph:
+    def __init__(self, envs):
+        self.environments = dict((env["Name"], env) for env in envs)
+        self.prior = dict((env["Name"], env["Prior"]) for env in envs)
+        for (name, prior) in self.prior.items():
+            if prior is not None and prior not in self.environments:
+                raise Exception("Lifecycle environment %s has unknown prior environment %s" % (name, prior))
+        checked = set()
+        for name in self.environments:
+            self.check_chain(name, checked)
+
+
+    # Raises an exception if the chain of prior environments of name has a cycle.
+    #  Environments in checked are known to lead to the root; the chain is added.
+    def check_chain(self, name, checked):
+        chain = []
+        while name is not None and name not in checked:
+            if name in chain:
+                raise Exception("Lifecycle environments form a cycle: %s" % (" - ".join(chain[chain.index(name):] + [name])))
+            chain.append(name)
+            name = self.prior[name]
+        checked.update(chain)
+
+
+    # Environments from the root to name, inclusive.
+    def ancestors(self, name):
+        chain = []
+        while name is not None:
+            chain.append(name)
+            name = self.prior[name]
+        return list(reversed(chain))
+
+
+    # The promotion path to toenv, from fromenv if given or else from the root,
+    # as a list of (from,to) pairs of environment names.
+    def path(self, toenv, fromenv=None):
+        if toenv not in self.environments or (fromenv is not None and fromenv not in self.environments):
+            if fromenv:
+                raise Exception("No promotion path exists from %s to %s" % (fromenv, toenv))
+            raise Exception("No promotion path exists to %s" % (toenv))
+        chain = self.ancestors(toenv)
+        if fromenv is not None:
+            if fromenv not in chain:
+                raise Exception("No promotion path exists from %s to %s" % (fromenv, toenv))
+            chain = chain[chain.index(fromenv):]
+        return list(zip(chain[:-1], chain[1:]))
+
+
+# The lifecycle environment graph, built once per run and organization.
+def get_environment_graph():
+    organization = current_organization()
+    if organization.environment_graph is None:
+        organization.environment_graph = EnvironmentGraph(get_lifecycle_environment_data())
+    return organization.environment_graph
 
 
 def get_promotion_path(promote_to_environment, promote_from_environment=None):
-    envs = get_lifecycle_environment_data()
-    def find_env(name):
-        for env in envs:
-            if env["Name"] == name:
-                return env
-        if promote_from_environment:
-            raise Exception("No promotion path exists from %s to %s" % (promote_from_environment, promote_to_environment))
-        raise Exception("No promotion path exists to %s" % (promote_to_environment))
-    if promote_from_environment:
-        # Ensure it exists.
-        find_env(promote_from_environment)
-    def walk(startenv, stopenv):
-        if startenv == stopenv:
-            return []
-        env = find_env(stopenv)
-        if env["Prior"] is None:
-            return []
-        return walk(startenv, env["Prior"]) + [(env["Prior"], env["Name"])]
-    path = walk(promote_from_environment, promote_to_environment)
+    path = get_environment_graph().path(promote_to_environment, promote_from_environment)
 
 
-    pathdesc = [path[0][0]] + [t for (f,t) in path]
+    pathdesc = [path[0][0]] + [t for (f,t) in path] if path else [promote_to_environment]
     if promote_from_environment:
         verbose_print([1,2], "Path from %s to %s: %s" % (promote_from_environment, promote_to_environment, " - ".join(pathdesc)), file=sys.stderr)
     else:
@@ -151,25 +1437,119 @@ def get_promotion_paths(promote_to_environments, **kwargs):
 
 
 #  the view must match the view id
-def get_content_view_description(content_view_name, content_view_id):
+def get_content_view_info(content_view_name, content_view_id):
     if content_view_id is None:
-        content_view_info = hammer("content-view", "info", "--organization-id", "1", "--name", content_view_name, updates=False)
+        return hammer("content-view", "info", "--organization-id", current_organization().id, "--name", content_view_name, updates=False)
     else:
-        content_view_info = hammer("content-view", "info", "--organization-id", "1", "--name", content_view_name, "--id", str(content_view_id), updates=False)
-    return content_view_info['Description']
+        return hammer("content-view", "info", "--organization-id", current_organization().id, "--name", content_view_name, "--id", str(content_view_id), updates=False)
+
+
+#  the view must match the view id
+def get_content_view_description(content_view_name, content_view_id):
+    return get_content_view_info(content_view_name, content_view_id)['Description']
+
+
+# Ids of the repositories in a content view.
+#  hammer lists them per content type ("Yum Repositories", "File Repositories", ...).
+#  the view must match the view id
+def get_content_view_repository_ids(content_view_name, content_view_id):
+    repository_ids = []
+    for (key, value) in get_content_view_info(content_view_name, content_view_id).items():
+        if key.endswith("Repositories") and isinstance(value, dict):
+            repository_ids.extend([str(repository["ID"]) for repository in value.values()])
+    return repository_ids
+
+
+# Parse a timestamp as printed by hammer or the API. Times without a zone are taken as UTC.
+#  Returns None if the value is not a timestamp (like "Not Synced").
+def parse_timestamp(value):
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if value.endswith(" UTC"):
+        value = value[:-4]
+    if value.endswith("Z"):
+        value = value[:-1] + "+0000"
+    value = re.sub(r"([+-][0-9][0-9]):([0-9][0-9])$", r"\1\2", value)
+    for format in ["%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%d %H:%M:%S%z", "%Y-%m-%d %H:%M:%S %z", "%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"]:
+        try:
+            timestamp = datetime.datetime.strptime(value, format)
+        except ValueError:
+            continue
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+        return timestamp
+    return None
+
+
+# When the content of a repository last changed, or None if unknown.
+#  A sync that brings in nothing new still moves the last sync date, so that
+#  is only used for servers that do not report when the content last changed.
+def get_repository_content_timestamp(repository_id):
+    # Not cached: repositories are synced by others while the script runs.
+    repository_info = hammer("repository", "info", "--id", repository_id, updates=False, cached=False)
+    sync = repository_info.get("Sync") or {}
+    for value in [repository_info.get("Content Last Updated"), sync.get("Last Sync Date"), repository_info.get("Updated")]:
+        timestamp = parse_timestamp(value)
+        if timestamp is not None:
+            return timestamp
+    return None
+
+
+# When a content view version was created, or None if unknown.
+def get_content_view_version_timestamp(content_view_version_id):
+    content_view_version_info = hammer("content-view", "version", "info", "--id", str(content_view_version_id), updates=False)
+    for key in ["Created", "Created At", "Published"]:
+        timestamp = parse_timestamp(content_view_version_info.get(key))
+        if timestamp is not None:
+            return timestamp
+    return None
+
+
+# Estimated disk footprint in bytes of a content view version.
+#  Uses the size reported by the server if there is one, or else the number of
+#  packages times package_size. Content shared between versions is counted for each.
+def get_content_view_version_size(content_view_version_id, package_size):
+    content_view_version_info = hammer("content-view", "version", "info", "--id", str(content_view_version_id), updates=False)
+    if content_view_version_info.get("Size") is not None:
+        return int(content_view_version_info["Size"])
+    return int(content_view_version_info.get("Packages") or 0) * package_size
+
+
+# Whether any repository of a (non-composite) content view may have changed since its latest version was published.
+#  Anything unknown counts as changed.
+#  the view must match the view id
+def content_view_has_new_content(content_view_name, content_view_id):
+    latest = get_latest_view_version(content_view_name, content_view_id)
+    if latest is None:
+        return True
+    published = get_content_view_version_timestamp(latest[1])
+    if published is None:
+        return True
+    for repository_id in get_content_view_repository_ids(content_view_name, content_view_id):
+        changed = get_repository_content_timestamp(repository_id)
+        if changed is None or changed > published:
+            verbose_print([1,2], "Repository %s of %s changed since %s." % (repository_id, content_view_name, published), file=sys.stderr)
+            return True
+    return False
 
 
 #  the view must match the view id
 def get_composite_view_component_versions(composite_view_name, composite_view_id):
-    composite_view_info = hammer("content-view", "info", "--organization-id", "1", "--name", composite_view_name, "--id", str(composite_view_id), updates=False)
+    composite_view_info = hammer("content-view", "info", "--organization-id", current_organization().id, "--name", composite_view_name, "--id", str(composite_view_id), updates=False)
     composite_view_component_versions = composite_view_info['Components'].values()
     # composite_view_component_versions will be a list of { "ID": 193, "Name": "misc-el7 9.0" }
     return [(component["Name"].rsplit(" ", 1)[0], component["ID"]) for component in composite_view_component_versions]
 
 
+# Ids of the component versions a composite view version was published with.
+def get_composite_version_component_versions(composite_version_id):
+    return set([version['ID'] for version in hammer_pages("content-view", "version", "list", "--composite-version-id", str(composite_version_id))])
+
+
 #  the view must match the view id
 def get_composite_view_components(composite_view_name, composite_view_id):
-    composite_view_info = hammer("content-view", "info", "--organization-id", "1", "--name", composite_view_name, "--id", str(composite_view_id), updates=False)
+    composite_view_info = hammer("content-view", "info", "--organization-id", current_organization().id, "--name", composite_view_name, "--id", str(composite_view_id), updates=False)
     composite_view_component_versions = composite_view_info['Components'].values()
     # composite_view_component_versions will be a list of { "ID": 193, "Name": "misc-el7 9.0" }
     composite_view_components = [(composite_view_component_version["Name"].rsplit(" ", 1)[0], None) for composite_view_component_version in composite_view_component_versions]
@@ -177,17 +1557,19 @@ def get_composite_view_components(composite_view_name, composite_view_id):
     return set(composite_view_components)
 
 
+# Iterate over the composite views, or only over the named ones.
+#  Names that do not match any composite view raise an exception once all pages are seen.
 def get_all_composite_view_data(composite_view_names):
-    data = hammer("content-view", "list", "--organization-id", "1", "--composite", "true", updates=False)
-    for composite_view in data:
+    missing_names = set(composite_view_names or [])
+    for composite_view in hammer_pages("content-view", "list", "--organization-id", current_organization().id, "--composite", "true"):
         assert(composite_view['Composite'])
-    if composite_view_names:
-        have_names = set([composite_view['Name'] for composite_view in data])
-        for name in composite_view_names:
-            if name not in have_names:
-                raise Exception("%s does not match any composite view" % (name))
-        return [composite_view for composite_view in data if composite_view['Name'] in composite_view_names]
-    return data
+        if composite_view_names and composite_view['Name'] not in composite_view_names:
+            continue
+        missing_names.discard(composite_view['Name'])
+        yield composite_view
+    for name in composite_view_names or []:
+        if name in missing_names:
+            raise Exception("%s does not match any composite view" % (name))
 
 
 def get_all_composite_views(composite_view_names):
@@ -195,22 +1577,28 @@ def get_all_composite_views(composite_view_names):
     return composite_view_and_view_ids
 
 
+# Find the component views of each composite view.
+#  Returns a dict from (composite_view_name, composite_view_id) to a set of (component_view_name, None).
+def get_all_composite_view_component_map(composite_view_names):
+    all_composite_views = get_all_composite_views(composite_view_names)
+    return dict(((composite_view_name, composite_view_id), get_composite_view_components(composite_view_name, composite_view_id)) for (composite_view_name, composite_view_id) in all_composite_views)
+
+
 # Find all component views which are in a composite view.
 def get_all_composite_view_components(composite_view_names):
-    all_composite_views = get_all_composite_views(composite_view_names)
-    components_sets_for_all_composite_views = [get_composite_view_components(composite_view_name, composite_view_id) for (composite_view_name, composite_view_id) in all_composite_views]
+    components_sets_for_all_composite_views = get_all_composite_view_component_map(composite_view_names).values()
     all_composite_view_components = union_of_all(*components_sets_for_all_composite_views)
     verbose_print([1,2], "All composite view components: %s" % str(all_composite_view_components), file=sys.stderr)
     return all_composite_view_components
 
 
-# Get all data about a content view.
+# Iterate over the versions of a content view, newest first, one page at a time.
 #  the view must match the view id
 def get_content_view_data(content_view_name, content_view_id):
     if content_view_id is None:
-        return hammer("content-view", "version", "list", "--organization-id", "1", "--content-view", content_view_name, updates=False)
+        return hammer_pages("content-view", "version", "list", "--organization-id", current_organization().id, "--content-view", content_view_name)
     else:
-        return hammer("content-view", "version", "list", "--organization-id", "1", "--content-view", content_view_name, "--content-view-id", str(content_view_id), updates=False)
+        return hammer_pages("content-view", "version", "list", "--organization-id", current_organization().id, "--content-view", content_view_name, "--content-view-id", str(content_view_id))
 
 
 # Given a conent view name and id, returns a list of content view versions, sorted by the given key.
@@ -222,12 +1610,11 @@ def get_sorted_content_view_data(*args, key='version'):
     keyfuns = {
         'version': version_key
     }
-    data = get_content_view_data(*args)
-    data.sort(key=keyfuns[key])
-    return data
+    return sorted(get_content_view_data(*args), key=keyfuns[key])
 
 
 # Given a content view name and id, returns the most current content view version.
+#  Stops listing versions at the first one in Library.
 #  the view must match the view id
 def get_latest_view_version(content_view_name, content_view_id):
     for content_view_version_info in get_content_view_data(content_view_name, content_view_id):
@@ -249,115 +1636,420 @@ def get_latest_view_versions(content_views):
 
 
 
-def remove_composite_view_component_version(composite_view_id, component_view_version_id):
-    res = hammer("content-view", "remove-version", "--id", str(composite_view_id), "--content-view-version-id", str(component_view_version_id))
-
-
-def add_composite_view_component_version(composite_view_id, component_view_version_id):
-    res = hammer("content-view", "add-version", "--id", str(composite_view_id), "--content-view-version-id", str(component_view_version_id))
-
-
-def update_composite_view_component_version(composite_view_id, configured_component_version_id, latest_component_version_id):
-    verbose_print([1,2], "For composite view %s, update from %s to %s." % (composite_view_id, configured_component_version_id, latest_component_version_id), file=sys.stderr)
-    remove_composite_view_component_version(composite_view_id, configured_component_version_id)
-    add_composite_view_component_version(composite_view_id, latest_component_version_id)
+# Set all component versions of a composite view in one update.
+def set_composite_view_component_versions(composite_view_id, component_version_ids):
+    hammer("content-view", "update", "--id", str(composite_view_id), "--component-ids", ",".join([str(component_version_id) for component_version_id in component_version_ids]))
 
 
 #  the view must match the view id
+# Returns whether any component version was changed.
 def update_composite_view_component_versions(composite_view_name, composite_view_id, latest_component_versions):
     configured_component_versions = get_composite_view_component_versions(composite_view_name, composite_view_id)
+    latest_component_version_ids = dict([latest_component_version for latest_component_version in latest_component_versions if latest_component_version is not None])
+
+
+    component_version_ids = []
+    for (configured_component_view_name, configured_component_version_id) in configured_component_versions:
+        latest_component_version_id = latest_component_version_ids.get(configured_component_view_name, configured_component_version_id)
+        if latest_component_version_id != configured_component_version_id:
+            verbose_print([1,2], "For composite view %s, update %s from %s to %s." % (composite_view_name, configured_component_view_name, configured_component_version_id, latest_component_version_id), file=sys.stderr)
+        component_version_ids.append(latest_component_version_id)
 
 
-    for (latest_component_view_name, latest_component_version_id) in latest_component_versions:
-        for (configured_component_view_name, configured_component_version_id) in configured_component_versions:
-            if latest_component_view_name == configured_component_view_name:
-                if latest_component_version_id != configured_component_version_id:
-                    update_composite_view_component_version(composite_view_id, configured_component_version_id, latest_component_version_id)
+    if component_version_ids == [configured_component_version_id for (configured_component_view_name, configured_component_version_id) in configured_component_versions]:
+        return False
+    set_composite_view_component_versions(composite_view_id, component_version_ids)
+    return True
 
 
-# composite_views is a an iterable of (content_view_name, content_view_id)
+# Whether the latest version of a composite view in Library was published with
+# the component versions set in the view now.
+#  Not so after the component versions were changed and the publish then
+#  failed or was interrupted.
 #  the view must match the view id
-def update_composite_views_component_versions(composite_views, latest_component_versions):
-    for (content_view_name, content_view_id) in composite_views:
-        update_composite_view_component_versions(content_view_name, content_view_id, latest_component_versions)
+def composite_view_published_with_component_versions(composite_view_name, composite_view_id):
+    latest = get_latest_view_version(composite_view_name, composite_view_id)
+    if latest is None:
+        return False
+    configured = set([str(component_version_id) for (component_view_name, component_version_id) in get_composite_view_component_versions(composite_view_name, composite_view_id)])
+    return configured == set([str(component_version_id) for component_version_id in get_composite_version_component_versions(latest[1])])
 
 
 # Deletes a content view version.
 #  May raise a subprocess.CalledProcessError on failure.
 def delete_content_view_version(content_view_name, content_view_id, content_view_version):
     if content_view_id is None:
-        hammer("content-view", "version", "delete", "--organization-id", "1", "--content-view", content_view_name, "--id", str(content_view_version['ID']), "--version", content_view_version['Version'])
+        hammer_task("content-view", "version", "delete", "--organization-id", current_organization().id, "--content-view", content_view_name, "--id", str(content_view_version['ID']), "--version", content_view_version['Version'])
     else:
-        hammer("content-view", "version", "delete", "--organization-id", "1", "--content-view", content_view_name, "--content-view-id", str(content_view_id), "--id", str(content_view_version['ID']), "--version", content_view_version['Version'])
+        hammer_task("content-view", "version", "delete", "--organization-id", current_organization().id, "--content-view", content_view_name, "--content-view-id", str(content_view_id), "--id", str(content_view_version['ID']), "--version", content_view_version['Version'])
 
 
-# Promote a content view from one environment to the next.
-#  fromenv must be the prior env of toenv
-#  the view name must match the view id
-#  the view must match the view id
-def promote_content_view_environment(content_view_name, content_view_id, fromenv, toenv, description, force_regen=False):
-    for content_view_version in get_content_view_data(content_view_name, content_view_id):
-        content_view_version_lifecycle_environments = content_view_version['Lifecycle Environments']
-        if fromenv in content_view_version_lifecycle_environments:
-            if toenv not in content_view_version_lifecycle_environments:
-                # Promote this version.
-                hammer("content-view", "version", "promote", "--organization-id", "1", "--content-view", content_view_name, "--content-view-id", str(content_view_id), "--from-lifecycle-environment", fromenv, "--to-lifecycle-environment", toenv, "--description", description, *(["--force-yum-metadata-regeneration", "true"] if force_regen else []))
-                return
+# Merge promotion paths into one list of edges, each edge once.
+#  Paths share prefixes (all start in the same tree of environments), so the
+#  merged list is still ordered so that an edge comes after the edge into its fromenv.
+# promotion_paths is a list of lists of (from,to) pairs of environment names.
+def merge_promotion_paths(promotion_paths):
+    edges = []
+    for promotion_path in promotion_paths:
+        for edge in promotion_path:
+            if edge not in edges:
+                edges.append(edge)
+    return edges
 
 
-# Promote a set of content views to <toenv>, if the content view is in <fromenv>.
-# content_views is a an iterable of (content_view_name, content_view_id)
-#  content_view_name must match content_view_id
-def promote_content_views_environment(content_views, fromenv, toenv, description, **kwargs):
-    for (content_view_name, content_view_id) in content_views:
-        promote_content_view_environment(content_view_name, content_view_id, fromenv, toenv, description, **kwargs)
+# Plan the promotions of a content view along the edges, from one listing of its versions.
+#  Returns a list of (content_view_version_id, fromenv, toenv), in the order of the edges.
+#  the view name must match the view id
+def plan_view_promotions(content_view_name, content_view_id, edges):
+    environment_versions = {}
+    for content_view_version in get_content_view_data(content_view_name, content_view_id):
+        for environment in content_view_version['Lifecycle Environments']:
+            environment_versions[environment] = content_view_version['ID']
+    plan = []
+    for (fromenv, toenv) in edges:
+        content_view_version_id = environment_versions.get(fromenv)
+        if content_view_version_id is not None and environment_versions.get(toenv) != content_view_version_id:
+            plan.append((content_view_version_id, fromenv, toenv))
+            environment_versions[toenv] = content_view_version_id
+    return plan
+
+
+# Promote a content view version from one environment to the next.
+#  fromenv must be the prior env of toenv
+#  the view name must match the view id
+def promote_content_view_version(content_view_name, content_view_id, content_view_version_id, fromenv, toenv, description, force_regen=False):
+    hammer_task("content-view", "version", "promote", "--organization-id", current_organization().id, "--content-view", content_view_name, "--content-view-id", str(content_view_id), "--id", str(content_view_version_id), "--from-lifecycle-environment", fromenv, "--to-lifecycle-environment", toenv, "--description", description, *(["--force-yum-metadata-regeneration", "true"] if force_regen else []), duration_key=("promote", content_view_name))
+    current_organization().summary.add("Promoted", "%s to %s" % (content_view_name, toenv))
+    current_organization().promoted_environments.add(toenv)
 
 
-# Promote a set of content views along the specified path.
-# content_views is a an iterable of (content_view_name, content_view_id)
-#  content_view_name must match content_view_id
-# promotion_path is a list of (from,to) pairs of environment names.
-def promote_views_along_path(content_views, promotion_path, description, **kwargs):
-    for (promote_from, promote_to) in promotion_path:
-        promote_content_views_environment(content_views, promote_from, promote_to, description, **kwargs)
+# Promote a content view along the edges, as planned by plan_view_promotions().
+#  the view name must match the view id
+def promote_view_along_edges(content_view_name, content_view_id, edges, description, **kwargs):
+    for (content_view_version_id, fromenv, toenv) in plan_view_promotions(content_view_name, content_view_id, edges):
+        promote_content_view_version(content_view_name, content_view_id, content_view_version_id, fromenv, toenv, description, **kwargs)
 
 
 # Promote a set of content views along the paths specified.
+#  Shared parts of the paths are promoted once; at most jobs views are promoted at the same time.
 # content_views is a an iterable of (content_view_name, content_view_id)
 #  content_view_name must match content_view_id
 # promotion_paths is a list of lists of (from,to) pairs of environment names.
-def promote_views_along_paths(content_views, promotion_paths, description, **kwargs):
-    for promotion_path in promotion_paths:
-        promote_views_along_path(content_views, promotion_path, description, **kwargs)
+# phase is that of the promotions in the metrics; None when they are part of a
+# step already counted.
+def promote_views_along_paths(content_views, promotion_paths, description, jobs=1, phase="promote", **kwargs):
+    edges = merge_promotion_paths(promotion_paths)
+    def promote(content_view):
+        (content_view_name, content_view_id) = content_view
+        promote_view_along_edges(content_view_name, content_view_id, edges, description, **kwargs)
+    def describe(content_view):
+        return "promote content view %s" % (content_view[0])
+    failures = run_parallel(promote, longest_first("promote", list(content_views)), jobs, describe=describe, phase=phase)
+    if failures:
+        raise Exception("Failed to promote %d content views: %s" % (len(failures), ", ".join(sorted([content_view_name for ((content_view_name, content_view_id), e) in failures]))))
+
+
+# Features of the smart proxies that are capsules with content, and of the
+# default smart proxy (on the Foreman server itself), which has the content
+# already and is never synced.
+CONTENT_CAPSULE_FEATURES = ["Pulp Node"]
+DEFAULT_CAPSULE_FEATURE = "Pulp"
+
+
+# Capsules with content from any of the environments.
+#  Returns a list of (capsule_id, capsule_name, [(environment_id, environment_name)]),
+#  with only the given environments. The default smart proxy and smart
+#  proxies without content are left out.
+def get_capsules_for_environments(environment_names):
+    capsules = []
+    for capsule in hammer("capsule", "list", "--organization-id", current_organization().id, updates=False):
+        capsule_id = str(capsule.get("ID", capsule.get("Id")))
+        features = [feature.strip() for feature in (capsule.get("Features") or "").split(",")]
+        if DEFAULT_CAPSULE_FEATURE in features:
+            verbose_print([1,2], "Capsule %s is the default smart proxy, not syncing it." % (capsule["Name"]), file=sys.stderr)
+            continue
+        if not [feature for feature in features if feature in CONTENT_CAPSULE_FEATURES]:
+            verbose_print([1,2], "Capsule %s has no content, not syncing it." % (capsule["Name"]), file=sys.stderr)
+            continue
+        environments = hammer("capsule", "content", "lifecycle-environments", "--organization-id", current_organization().id, "--id", capsule_id, updates=False)
+        environments = [(str(environment["ID"]), environment["Name"]) for environment in environments or [] if environment["Name"] in environment_names]
+        if environments:
+            capsules.append((capsule_id, capsule["Name"], environments))
+    return capsules
+
+
+# Sync the capsules with content from any of the environments, so that their
+# hosts get promoted content now instead of at the next scheduled sync.
+#  Each capsule syncs the environments one after the other; at most jobs
+#  capsules sync at the same time. The time each took goes in the run summary.
+def sync_capsules(environment_names, jobs=1):
+    capsules = get_capsules_for_environments(environment_names)
+    def sync(capsule):
+        (capsule_id, capsule_name, environments) = capsule
+        start = time.monotonic()
+        for (environment_id, environment_name) in environments:
+            hammer_task("capsule", "content", "synchronize", "--id", capsule_id, "--lifecycle-environment-id", environment_id)
+        seconds = time.monotonic() - start
+        verbose_print([1,2], "Synced capsule %s in %d seconds." % (capsule_name, seconds), file=sys.stderr)
+        current_organization().summary.add("Synced capsules", "%s (%s) in %d s" % (capsule_name, ", ".join([environment_name for (environment_id, environment_name) in environments]), seconds))
+    def describe(capsule):
+        return "sync capsule %s" % (capsule[1])
+    failures = run_parallel(sync, capsules, jobs, describe=describe, phase="sync")
+    if failures:
+        raise Exception("Failed to sync %d capsules: %s" % (len(failures), ", ".join(sorted([capsule_name for ((capsule_id, capsule_name, environments), e) in failures]))))
 
 
 #  the view must match the view id
-def update_view(content_view_name, content_view_id, description):
+# With only_if_changed, the view is not published unless content_view_has_new_content().
+# Returns whether the view was published.
+def update_view(content_view_name, content_view_id, description, only_if_changed=False, timeout=None):
     desc = get_content_view_description(content_view_name, content_view_id)
     if desc is not None and ":noautoupdate:" in desc:
-        return
+        return False
+    if only_if_changed and not content_view_has_new_content(content_view_name, content_view_id):
+        verbose_print([1,2], "No new content in %s, not publishing." % (content_view_name), file=sys.stderr)
+        current_organization().summary.add("Not published, no new content", content_view_name)
+        return False
     if content_view_id is None:
-        hammer("content-view", "publish", "--organization-id", "1", "--name", content_view_name, "--description", description)
+        hammer_task("content-view", "publish", "--organization-id", current_organization().id, "--name", content_view_name, "--description", description, timeout=timeout, duration_key=("publish", content_view_name))
     else:
-        hammer("content-view", "publish", "--organization-id", "1", "--name", content_view_name, "--id", str(content_view_id), "--description", description)
+        hammer_task("content-view", "publish", "--organization-id", current_organization().id, "--name", content_view_name, "--id", str(content_view_id), "--description", description, timeout=timeout, duration_key=("publish", content_view_name))
+    current_organization().summary.add("Published", content_view_name)
+    return True
 
 
 # content_views is a an iterable of (content_view_name, content_view_id)
 #  the view must match the view id
-def update_views(content_views, description):
-    for (content_view_name, content_view_id) in content_views:
-        update_view(content_view_name, content_view_id, description)
+# At most jobs views are published at the same time, each for at most timeout seconds.
+def update_views(content_views, description, jobs=1, timeout=None):
+    def update(content_view):
+        (content_view_name, content_view_id) = content_view
+        update_view(content_view_name, content_view_id, description, timeout=timeout)
+    def describe(content_view):
+        return "publish content view %s" % (content_view[0])
+    failures = run_parallel(update, longest_first("publish", list(content_views)), jobs, describe=describe, phase="publish")
+    if failures:
+        raise Exception("Failed to publish %d content views: %s" % (len(failures), ", ".join(sorted([content_view_name for ((content_view_name, content_view_id), e) in failures]))))
+
+
+
+
+# Write-ahead journal of the steps of a run, so that an interrupted run can be resumed.
+#  Every step is recorded as one JSON line when it starts and again when it is
+#  done, and written to disk at once. Without a path nothing is recorded.
+class Journal:
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.steps = {}
+        if path is None:
+            return
+        if resume and os.path.exists(path):
+            with open(path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut short.
+                        continue
+                    self.steps.setdefault((entry["step"], entry["view"]), {}).update(entry)
+            verbose_print([1,2], "Resuming from journal %s (%d steps)." % (path, len(self.steps)), file=sys.stderr)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+
+
+    def write(self, entry):
+        with self.lock:
+            self.steps.setdefault((entry["step"], entry["view"]), {}).update(entry)
+            if self.path is None:
+                return
+            with open(self.path, "a") as journal_file:
+                journal_file.write(json.dumps(entry) + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
 
+    def start(self, step, view, **data):
+        self.write(dict(data, step=step, view=view, started_at=datetime.datetime.now(datetime.timezone.utc).isoformat(), done=False))
 
 
+    def finish(self, step, view, **data):
+        self.write(dict(data, step=step, view=view, done=True))
 
 
+    # The merged entries of a step, or None if it was never started.
+    def get(self, step, view):
+        with self.lock:
+            return self.steps.get((step, view))
+
+
+    # Remove the journal after a completed run.
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_journal_path(state_dir, description):
+    return os.path.join(os.path.expanduser(state_dir), "journal-%s-%s.jsonl" % (current_organization().id, re.sub(r"[^A-Za-z0-9_.-]", "_", description)))
+
+
+# Number of durations kept per operation and view.
+HISTORY_LENGTH = 10
+
+
+# An operation is flagged as slow when it takes more than SLOW_FACTOR times
+# its usual duration, and at least SLOW_MARGIN seconds more.
+SLOW_FACTOR = 2.0
+SLOW_MARGIN = 300
+
+
+# Durations of earlier publishes and promotions, per operation and view, kept in the state directory.
+#  The usual duration (the median of the last ones) is used to start the
+#  longest operations first and to estimate how long a run will take.
+#  Operations taking much longer than usual are flagged in the run summary.
+#  Without record, durations are used but not recorded (for --snapshot runs).
+class DurationHistory:
+    def __init__(self, path, record=True):
+        self.path = path
+        self.recording = record
+        self.durations = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path) as history_file:
+                    self.durations = json.load(history_file)
+            except ValueError as e:
+                print("Ignoring unreadable duration history %s: %s" % (path, e), file=sys.stderr)
+
+
+    # The usual duration in seconds, or None if there is no history.
+    def estimate(self, operation, content_view_name):
+        with self.lock:
+            durations = sorted(self.durations.get(operation, {}).get(content_view_name, []))
+        if not durations:
+            return None
+        return durations[len(durations) // 2]
+
+
+    def record(self, operation, content_view_name, seconds):
+        if not self.recording:
+            return
+        usual = self.estimate(operation, content_view_name)
+        with self.lock:
+            durations = self.durations.setdefault(operation, {}).setdefault(content_view_name, [])
+            known = len(durations)
+            durations.append(round(seconds, 1))
+            del durations[0:-HISTORY_LENGTH]
+            self.changed = True
+        if known >= 3 and seconds > SLOW_FACTOR * usual and seconds - usual > SLOW_MARGIN:
+            print("%sSlow: %s %s took %s, usually %s" % (organization_prefix(), operation, content_view_name, format_duration(seconds), format_duration(usual)), file=sys.stderr)
+            current_organization().summary.add("Slower than usual", "%s %s (%s, usually %s)" % (operation, content_view_name, format_duration(seconds), format_duration(usual)))
+
+
+    def save(self):
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary = "%s.%d.tmp" % (self.path, os.getpid())
+        with self.lock:
+            with open(temporary, "w") as history_file:
+                json.dump(self.durations, history_file, indent=1, sort_keys=True)
+        os.replace(temporary, self.path)
+
+
+def get_history_path(state_dir):
+    return os.path.join(os.path.expanduser(state_dir), "durations-%s.json" % (current_organization().id))
+
+
+# Estimated seconds of an operation on each of the views, from the duration history.
+#  Views without history are taken to be as long as the others on average.
+#  Returns (a dict from view name to seconds, the number of views without history);
+#  the dict is empty if there is no history of the operation for any of the views.
+def estimate_durations(operation, content_view_names):
+    history = current_organization().history
+    known = {}
+    if history is not None:
+        for content_view_name in content_view_names:
+            seconds = history.estimate(operation, content_view_name)
+            if seconds is not None:
+                known[content_view_name] = seconds
+    if not known:
+        return ({}, len(content_view_names))
+    typical = sum(known.values()) / len(known)
+    return (dict((content_view_name, known.get(content_view_name, typical)) for content_view_name in content_view_names), len(content_view_names) - len(known))
+
+
+# Order views by the usual duration of the operation, longest first, so that
+# the runs done in parallel end at about the same time.
+# content_views is a an iterable of (content_view_name, content_view_id)
+def longest_first(operation, content_views):
+    (estimates, unknown) = estimate_durations(operation, [content_view_name for (content_view_name, content_view_id) in content_views])
+    return sorted(content_views, key=lambda content_view: -estimates.get(content_view[0], 0))
+
+
+def print_estimate(seconds, operations, unknown):
+    done = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+    print("%sEstimated time: %s for %d operations%s, done around %s" % (organization_prefix(), format_duration(seconds), operations, " (%d without history)" % (unknown) if unknown else "", done.strftime("%H:%M")))
+
+
+# Whether a publish recorded in the journal is still in effect on the server.
+#  A publish which is done must have made the current latest version. For a
+#  publish which was started but not recorded as done, a latest version created
+#  after the start counts as that publish.
+#  the view must match the view id
+def journal_publish_done(journal, content_view_name, content_view_id):
+    entry = journal.get("publish", content_view_name)
+    if entry is None:
+        return False
+    latest = get_latest_view_version(content_view_name, content_view_id)
+    if latest is None:
+        return False
+    if entry["done"]:
+        return latest[1] == entry["version_id"]
+    created = get_content_view_version_timestamp(latest[1])
+    return created is not None and created >= parse_timestamp(entry["started_at"])
+
+
+# Publish a view and record it in the journal, unless the journal shows it was already published.
+#  Returns whether the view is published (by now or before).
+#  the view must match the view id
+def journal_update_view(journal, content_view_name, content_view_id, description, **kwargs):
+    if journal_publish_done(journal, content_view_name, content_view_id):
+        verbose_print([1,2], "Already published %s in the resumed run." % (content_view_name), file=sys.stderr)
+        current_organization().summary.add("Already published in the resumed run", content_view_name)
+        return True
+    journal.start("publish", content_view_name)
+    if not update_view(content_view_name, content_view_id, description, **kwargs):
+        return False
+    latest = get_latest_view_version(content_view_name, content_view_id)
+    journal.finish("publish", content_view_name, version_id=latest[1] if latest else None)
+    return True
+
+
+
+
+# How to run the interrupted or failed update again: with the same arguments
+# and description, and --resume.
+def print_resume_hint(args, journal):
+    if journal.path is None:
+        return
+    arguments = sys.argv[1:]
+    if not [argument for argument in arguments if argument == "--description" or argument.startswith("--description=")]:
+        arguments = ["--description", args.description] + arguments
+    if not args.resume:
+        arguments = arguments + ["--resume"]
+    print("%sTo continue: %s" % (organization_prefix(), " ".join([shlex.quote(argument) for argument in [sys.argv[0]] + arguments])), file=sys.stderr)
+
 
 # Update composite views and optionally promote to an environment (typically the staging environment).
 #  - Update the component views.
 #  - Change the component view versions in the composite views.
 #  - Update the composite views.
 #  - Optionally promote the composite views to the specified environments.
+# Each step runs as soon as the steps it depends on are done, so a composite view
+# only waits for its own component views.
 def cmd_update(args):
     ensure_auth_session()
 
@@ -366,34 +2058,365 @@ def cmd_update(args):
     promotion_paths = get_promotion_paths(args.promote_to) if args.promote_to else []
 
 
-    # Update the component views.
-    components_to_update = get_all_composite_view_components(args.composite_view_names)
-    update_views(components_to_update, args.description)
-    latest_component_versions = get_latest_view_versions(components_to_update)
-
-
-    all_composite_views = get_all_composite_views(args.composite_view_names)
+    composite_view_components = get_all_composite_view_component_map(args.composite_view_names)
+    all_components = union_of_all(*composite_view_components.values())
+    verbose_print([1,2], "All composite view components: %s" % str(all_components), file=sys.stderr)
+
+
+    # Completed steps are journaled per run description, to be able to --resume.
+    journal = Journal(get_journal_path(args.state_dir, args.description) if global_variables["allow_updates"] and not args.snapshot else None, resume=args.resume)
+
+
+    tasks = {}
+    dependencies = {}
+    # Update the component views which have new content.
+    for component_view in all_components:
+        def publish(component_view=component_view):
+            journal_update_view(journal, component_view[0], component_view[1], args.description, only_if_changed=not args.force_publish)
+        tasks[("publish", component_view)] = publish
+
+
+    # Composite views with changed component versions; only these are published and promoted.
+    #  A composite re-pinned by the resumed run, or earlier re-pinned but not
+    #  published, counts as changed.
+    changed_composite_views = set()
+    for (composite_view, component_views) in composite_view_components.items():
+        # Change the component view versions in the composite view.
+        def repin(composite_view=composite_view, component_views=component_views):
+            latest_component_versions = get_latest_view_versions(component_views)
+            changed = update_composite_view_component_versions(composite_view[0], composite_view[1], latest_component_versions)
+            if not changed and not composite_view_published_with_component_versions(composite_view[0], composite_view[1]):
+                verbose_print([1,2], "Composite view %s was not published with its component versions." % (composite_view[0]), file=sys.stderr)
+                changed = True
+            journaled = journal.get("repin", composite_view[0])
+            changed = changed or (journaled is not None and journaled["changed"])
+            journal.finish("repin", composite_view[0], changed=changed)
+            if changed or args.force_publish:
+                changed_composite_views.add(composite_view)
+            else:
+                current_organization().summary.add("Not published or promoted, no component version changed", composite_view[0])
+        tasks[("repin", composite_view)] = repin
+        dependencies[("repin", composite_view)] = [("publish", component_view) for component_view in component_views]
+
+
+        # Update the composite view.
+        def publish_composite(composite_view=composite_view):
+            if composite_view in changed_composite_views:
+                journal_update_view(journal, composite_view[0], composite_view[1], args.description)
+        tasks[("publish", composite_view)] = publish_composite
+        dependencies[("publish", composite_view)] = [("repin", composite_view)]
+
+
+        if promotion_paths:
+            # Promotions need no reconciling: what is already promoted is not planned again.
+            def promote(composite_view=composite_view):
+                if composite_view in changed_composite_views:
+                    journal.start("promote", composite_view[0])
+                    promote_views_along_paths([composite_view], promotion_paths, args.description, phase=None, force_regen=args.force_regen)
+                    journal.finish("promote", composite_view[0])
+            tasks[("promote", composite_view)] = promote
+            dependencies[("promote", composite_view)] = [("publish", composite_view)]
+
+
+    def describe(key):
+        (step, (content_view_name, content_view_id)) = key
+        return "%s %s" % (step, content_view_name)
+    # Estimate as if every view is published and promoted along every edge.
+    (publish_estimates, unknown_publishes) = estimate_durations("publish", [content_view_name for (step, (content_view_name, content_view_id)) in tasks if step == "publish"])
+    (promote_estimates, unknown_promotes) = estimate_durations("promote", [content_view_name for (step, (content_view_name, content_view_id)) in tasks if step == "promote"])
+    durations = {}
+    edge_count = len(merge_promotion_paths(promotion_paths))
+    for (step, (content_view_name, content_view_id)) in tasks:
+        if step == "publish":
+            durations[(step, (content_view_name, content_view_id))] = publish_estimates.get(content_view_name, 0)
+        elif step == "promote":
+            durations[(step, (content_view_name, content_view_id))] = promote_estimates.get(content_view_name, 0) * edge_count
+    if publish_estimates or promote_estimates:
+        critical_path = max(critical_path_lengths(tasks, dependencies, durations).values())
+        print_estimate(max(critical_path, sum(durations.values()) / max(1, args.jobs)), len(durations), unknown_publishes + unknown_promotes)
+    try:
+        (results, failures, blocked) = run_task_graph(tasks, dependencies, args.jobs, describe=describe, durations=durations, phase=lambda key: key[0])
+    except KeyboardInterrupt:
+        print_resume_hint(args, journal)
+        raise
+    if failures:
+        print_resume_hint(args, journal)
+        raise Exception("Update failed: %d steps failed, %d steps not run" % (len(failures), len(blocked)))
+    journal.remove()
+    if args.sync_capsules and current_organization().promoted_environments:
+        sync_capsules(current_organization().promoted_environments, jobs=args.capsule_jobs)
 
 
-    # Change the component view versions in the composite views.
-    update_composite_views_component_versions(all_composite_views, latest_component_versions)
+# Promote all composite views (typically from the staging environment to production).
+def cmd_promote(args):
+    ensure_auth_session()
 
 
-    # Update the composite views.
-    update_views(all_composite_views, args.description)
+    promotion_paths = get_promotion_paths(args.promote_to, promote_from_environment=args.promote_from)
+    all_composite_views = get_all_composite_views(args.composite_view_names)
+    (estimates, unknown) = estimate_durations("promote", [content_view_name for (content_view_name, content_view_id) in all_composite_views])
+    if estimates:
+        edge_count = len(merge_promotion_paths(promotion_paths))
+        print_estimate(estimate_makespan([seconds * edge_count for seconds in estimates.values()], args.jobs), len(estimates), unknown)
+    promote_views_along_paths(all_composite_views, promotion_paths, args.description, jobs=args.jobs, force_regen=args.force_regen)
+    if args.sync_capsules and current_organization().promoted_environments:
+        sync_capsules(current_organization().promoted_environments, jobs=args.capsule_jobs)
+
+
+# Find the (non-composite) content views matching names or shell-style patterns.
+#  Returns a list of (content_view_name, content_view_id), in the order listed by the server.
+#  Raises an exception if a name or pattern matches no view.
+def get_content_views_matching(patterns):
+    views = [(view['Name'], view['Content View ID']) for view in hammer_pages("content-view", "list", "--organization-id", current_organization().id) if not view['Composite']]
+    for pattern in patterns:
+        if not [content_view_name for (content_view_name, content_view_id) in views if fnmatch.fnmatchcase(content_view_name, pattern)]:
+            raise Exception("%s does not match any content view" % (pattern))
+    return [(content_view_name, content_view_id) for (content_view_name, content_view_id) in views if [pattern for pattern in patterns if fnmatch.fnmatchcase(content_view_name, pattern)]]
+
+
+# Publish content views, given by name or pattern, independent of composite views.
+#  At most --jobs views are published at the same time, and the command returns
+#  when the last one is done. With --timeout a publish still running after that
+#  long counts as failed, although the task goes on.
+def cmd_publish(args):
+    ensure_auth_session()
 
 
-    promote_views_along_paths(all_composite_views, promotion_paths, args.description, force_regen=args.force_regen)
+    content_views = get_content_views_matching(args.names)
+    if args.timeout is not None and global_variables["task_poller"] is None:
+        # Only polled tasks can be given up on; poll at least once within the timeout.
+        set_task_poller(TaskPoller(interval=min(args.poll_interval, args.timeout)))
+    (estimates, unknown) = estimate_durations("publish", [content_view_name for (content_view_name, content_view_id) in content_views])
+    if estimates:
+        print_estimate(estimate_makespan(estimates.values(), args.jobs), len(estimates), unknown)
+    update_views(content_views, args.description, jobs=args.jobs, timeout=args.timeout)
 
 
-# Promote all composite views (typically from the staging environment to production).
-def cmd_promote(args):
+# Map repositories to the content views containing them.
+#  Returns two dicts, from repository id and from repository name, to sets of (content_view_name, content_view_id).
+# content_views is a an iterable of (content_view_name, content_view_id)
+def get_repository_content_views(content_views):
+    by_id = {}
+    by_name = {}
+    for content_view in content_views:
+        for (key, value) in get_content_view_info(*content_view).items():
+            if key.endswith("Repositories") and isinstance(value, dict):
+                for repository in value.values():
+                    by_id.setdefault(str(repository["ID"]), set()).add(content_view)
+                    by_name.setdefault(repository["Name"], set()).add(content_view)
+    return (by_id, by_name)
+
+
+# Finished repository sync tasks, newest first.
+#  All of them, page by page, or with newest_only only the first page.
+def get_finished_sync_tasks(ended_since=None, newest_only=False, per_page=100):
+    search = "label = Actions::Katello::Repository::Sync and state = stopped and result ^ (success, warning)"
+    if ended_since:
+        search += " and ended_at >= \"%s\"" % (ended_since)
+    if newest_only:
+        return hammer("task", "list", "--search", search, "--per-page", str(per_page), updates=False, cached=False) or []
+    return list(hammer_pages("task", "list", "--search", search, per_page=per_page, cached=False))
+
+
+# The repository of a sync task, as (id, name); either may be None.
+#  The API gives the task input; hammer only the description, like
+#  "Synchronize repository 'x'; product 'y'; organization 'z'".
+def get_sync_task_repository(task):
+    repository = (task.get("Input") or {}).get("repository") or {}
+    if repository.get("id") is not None:
+        return (str(repository["id"]), repository.get("name"))
+    match = re.search(r"[Rr]epository '([^']*)'", task.get("Action") or "")
+    return (None, match.group(1) if match else None)
+
+
+# Publish component views when their repositories have been synced.
+#  Finished sync tasks are polled every interval seconds. A view is published
+#  once none of its repositories has finished a sync for debounce seconds (by
+#  the "Ended At" of the sync tasks), so that a burst of syncs gives one
+#  publish. Publishes are described by the time they start.
+def cmd_watch(args):
     ensure_auth_session()
 
 
-    promotion_paths = get_promotion_paths(args.promote_to, promote_from_environment=args.promote_from)
-    all_composite_views = get_all_composite_views(args.composite_view_names)
-    promote_views_along_paths(all_composite_views, promotion_paths, args.description, force_regen=args.force_regen)
+    organization = current_organization()
+    # Task id -> "Ended At", of the tasks ending at ended_since or later (which
+    # the next round gets again).
+    seen = {}
+    ended_since = None
+    # Content view -> when the last sync of one of its repositories ended.
+    pending = {}
+    first = True
+    while True:
+        try:
+            # Everything is read anew in each round.
+            organization.cache = HammerCache()
+            # The first round only needs the newest sync, to know where to start.
+            tasks = [task for task in get_finished_sync_tasks(ended_since, newest_only=first) if task["ID"] not in seen]
+            if tasks:
+                ended_since = max([ended_since or ""] + [task.get("Ended At") or "" for task in tasks]) or None
+                seen.update([(task["ID"], task.get("Ended At") or "") for task in tasks])
+                seen = dict([(task_id, ended) for (task_id, ended) in seen.items() if ended >= (ended_since or "")])
+            if first:
+                # Syncs from before we started have been handled by earlier runs.
+                first = False
+                tasks = []
+            if tasks:
+                (by_id, by_name) = get_repository_content_views(get_all_composite_view_components(args.composite_view_names))
+                for task in tasks:
+                    (repository_id, repository_name) = get_sync_task_repository(task)
+                    content_views = by_id.get(repository_id) or by_name.get(repository_name) or set()
+                    verbose_print([1,2], "Repository %s synced, used in: %s" % (repository_name or repository_id, ", ".join(sorted([content_view[0] for content_view in content_views])) or "no watched view"), file=sys.stderr)
+                    ended = parse_timestamp(task.get("Ended At")) or datetime.datetime.now(datetime.timezone.utc)
+                    for content_view in content_views:
+                        pending[content_view] = max(pending.get(content_view, ended), ended)
+            now = datetime.datetime.now(datetime.timezone.utc)
+            ready = [content_view for (content_view, synced) in pending.items() if (now - synced).total_seconds() >= args.debounce]
+            for content_view in ready:
+                del pending[content_view]
+            if ready:
+                description = datetime.datetime.now().strftime("%Y%m%d-%H%M")
+                def publish(content_view):
+                    update_view(content_view[0], content_view[1], description, only_if_changed=True)
+                run_parallel(publish, ready, args.jobs, describe=lambda content_view: "publish content view %s" % (content_view[0]), phase="publish")
+                organization.summary.print()
+                organization.summary = RunSummary()
+        except Exception as e:
+            print("%sWatch round failed, will retry: %s" % (organization_prefix(), e), file=sys.stderr)
+        time.sleep(args.interval)
+
+
+# Ids of the content view versions set as component versions of any composite view.
+def get_pinned_component_versions():
+    return set(component_version_id for (composite_view_name, composite_view_id) in get_all_composite_views(None) for (component_view_name, component_version_id) in get_composite_view_component_versions(composite_view_name, composite_view_id))
+
+
+# Find the versions which can be expired, from one listing of the versions of each view.
+#  Of the versions older than the keep latest ones, those in a lifecycle environment
+#  or used by a composite view can not be deleted and are left alone.
+#  Returns a list of (content_view_name, content_view_id, content_view_version, reason), oldest first for each view.
+# content_views is a an iterable of (content_view_name, content_view_id)
+def plan_expire(content_views, keep, pinned_component_versions):
+    plan = []
+    for (content_view_name, content_view_id) in content_views:
+        versions = get_sorted_content_view_data(content_view_name, content_view_id, key='version')
+        for version in versions[0:-keep]:
+            description = "%s %s" % (content_view_name, version['Version'])
+            if version['Lifecycle Environments']:
+                current_organization().summary.add("Not expired, in a lifecycle environment", description)
+            elif version['ID'] in pinned_component_versions:
+                current_organization().summary.add("Not expired, used by a composite view", description)
+            else:
+                plan.append((content_view_name, content_view_id, version, "more than %d newer versions" % (keep)))
+    return plan
+
+
+# Leave the component versions used by the composite view versions which are
+# not expired out of the plan.
+#  The server refuses to delete them. Looked up for at most jobs composite view
+#  versions at the same time, and only if there are component versions to expire.
+# composite_views is a an iterable of (content_view_name, content_view_id), of
+# all composite views: components may be shared with views not expired now.
+def keep_components_of_kept_composite_versions(plan, composite_views, jobs):
+    composite_view_names = set([content_view_name for (content_view_name, content_view_id) in composite_views])
+    if not [entry for entry in plan if entry[0] not in composite_view_names]:
+        return plan
+    planned = set([entry[2]['ID'] for entry in plan])
+    kept = [version['ID'] for (content_view_name, content_view_id) in composite_views for version in get_content_view_data(content_view_name, content_view_id) if version['ID'] not in planned]
+    protected = set()
+    def components(version_id):
+        protected.update(get_composite_version_component_versions(version_id))
+    failures = run_parallel(components, kept, jobs, describe=lambda version_id: "get components of content view version %s" % (version_id), phase="read")
+    if failures:
+        raise Exception("Failed to get the components of %d composite view versions" % (len(failures)))
+    result = []
+    for entry in plan:
+        if entry[0] not in composite_view_names and entry[2]['ID'] in protected:
+            current_organization().summary.add("Not expired, used by a kept composite view version", "%s %s" % (entry[0], entry[2]['Version']))
+        else:
+            result.append(entry)
+    return result
+
+
+# Creation time and estimated size of all versions of the views, gathered in one (parallel) pass.
+#  Returns a dict from content view version id to (created, size); created may be None.
+# content_views is a an iterable of (content_view_name, content_view_id)
+def get_version_footprints(content_views, package_size, jobs):
+    version_ids = [version['ID'] for (content_view_name, content_view_id) in content_views for version in get_content_view_data(content_view_name, content_view_id)]
+    footprints = {}
+    def footprint(version_id):
+        footprints[version_id] = (get_content_view_version_timestamp(version_id), get_content_view_version_size(version_id, package_size))
+    failures = run_parallel(footprint, version_ids, jobs, describe=lambda version_id: "get content view version %s" % (version_id), phase="footprint")
+    if failures:
+        raise Exception("Failed to get the size of %d content view versions" % (len(failures)))
+    return footprints
+
+
+# Narrow an expire plan down by the policy limits; None means no limit.
+#  Versions older than max_age are expired. Then the oldest remaining versions are
+#  expired while their view takes more than view_budget bytes, and then while all
+#  views together take more than budget bytes.
+#  Without any limit the plan is returned unchanged.
+def apply_expire_policy(plan, content_views, footprints, max_age=None, view_budget=None, budget=None):
+    if max_age is None and view_budget is None and budget is None:
+        return plan
+    now = datetime.datetime.now(datetime.timezone.utc)
+    totals = dict((content_view_name, sum([footprints[version['ID']][1] for version in get_content_view_data(content_view_name, content_view_id)])) for (content_view_name, content_view_id) in content_views)
+    selected = []
+    remaining = []
+    def select(entry, reason):
+        (content_view_name, content_view_id, version, old_reason) = entry
+        selected.append((content_view_name, content_view_id, version, reason))
+        totals[content_view_name] -= footprints[version['ID']][1]
+    for entry in plan:
+        created = footprints[entry[2]['ID']][0]
+        if max_age is not None and created is not None and now - created > max_age:
+            select(entry, "older than %d days" % (max_age.days))
+        else:
+            remaining.append(entry)
+    if view_budget is not None:
+        for entry in list(remaining):
+            if totals[entry[0]] > view_budget:
+                select(entry, "view over %s" % (format_size(view_budget)))
+                remaining.remove(entry)
+    if budget is not None:
+        remaining.sort(key=lambda entry: footprints[entry[2]['ID']][0] or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc))
+        for entry in list(remaining):
+            if sum(totals.values()) > budget:
+                select(entry, "total over %s" % (format_size(budget)))
+                remaining.remove(entry)
+    for entry in remaining:
+        current_organization().summary.add("Not expired, within age and size limits", "%s %s" % (entry[0], entry[2]['Version']))
+    return selected
+
+
+def print_expire_plan(plan, footprints, file=sys.stdout):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    rows = [("View", "Version", "Age (days)", "Size (est.)", "Reason")]
+    freed = 0
+    for (content_view_name, content_view_id, version, reason) in plan:
+        (created, size) = footprints.get(version['ID'], (None, None))
+        rows.append((content_view_name, version['Version'], str((now - created).days) if created is not None else "?", format_size(size) if size is not None else "?", reason))
+        freed += size or 0
+    widths = [max([len(row[i]) for row in rows]) for i in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join([value.ljust(width) for (value, width) in zip(row, widths)]).rstrip(), file=file)
+    print("%d versions, %s freed (estimated)" % (len(plan), format_size(freed)), file=file)
+
+
+# Delete the planned versions, at most jobs at the same time.
+def expire_versions(plan, jobs):
+    def expire(planned):
+        (content_view_name, content_view_id, version, reason) = planned
+        try:
+            delete_content_view_version(content_view_name, content_view_id, version)
+        except subprocess.CalledProcessError as e:
+            verbose_print([1,2], "Ignoring error while deleting content view {} (id {}) version {}: {}".format(content_view_name, content_view_id, version, e), file=sys.stderr)
+            verbose_print([0,1,2], "Skipped content view {} (id {}) version {}".format(content_view_name, content_view_id, version))
+            return
+        current_organization().summary.add("Expired", "%s %s" % (content_view_name, version['Version']))
+    def describe(planned):
+        return "expire content view %s version %s" % (planned[0], planned[2]['Version'])
+    return run_parallel(expire, plan, jobs, describe=describe, phase="expire")
 
 
 # Expire content views.
@@ -406,18 +2429,214 @@ def cmd_expire(args):
 
     all_composite_views = get_all_composite_views(args.composite_view_names)
     components_to_expire = list(get_all_composite_view_components(args.composite_view_names))
+    pinned_component_versions = get_pinned_component_versions()
+
+
+    plan = plan_expire(all_composite_views + components_to_expire, keep, pinned_component_versions)
+    footprints = {}
+    if args.max_age is not None or args.view_budget is not None or args.budget is not None or args.plan:
+        footprints = get_version_footprints(all_composite_views + components_to_expire, args.package_size, args.jobs)
+        max_age = datetime.timedelta(days=args.max_age) if args.max_age is not None else None
+        plan = apply_expire_policy(plan, all_composite_views + components_to_expire, footprints, max_age=max_age, view_budget=args.view_budget, budget=args.budget)
+    plan = keep_components_of_kept_composite_versions(plan, get_all_composite_views(None), args.jobs)
+    if args.plan:
+        print_expire_plan(plan, footprints)
+        return
 
 
     # Expire composite views first, then their components.
-    for (content_view_name, content_view_id) in all_composite_views + components_to_expire:
-        versions = get_sorted_content_view_data(content_view_name, content_view_id, key='version')
-        try_expire = versions[0:-keep]
-        for version in try_expire:
-            try:
-                delete_content_view_version(content_view_name, content_view_id, version)
-            except subprocess.CalledProcessError as e:
-                verbose_print([1,2], "Ignoring error while deleting content view {} (id {}) version {}: {}".format(content_view_name, content_view_id, version, e), file=sys.stderr)
-                verbose_print([0,1,2], "Skipped content view {} (id {}) version {}".format(content_view_name, content_view_id, version))
+    composite_view_names = set([content_view_name for (content_view_name, content_view_id) in all_composite_views])
+    failures = expire_versions([entry for entry in plan if entry[0] in composite_view_names], args.jobs)
+    failures += expire_versions([entry for entry in plan if entry[0] not in composite_view_names], args.jobs)
+    if failures:
+        raise Exception("Failed to expire %d content view versions" % (len(failures)))
+
+
+# Write the views, versions, environments and composite view components of the
+# organization to a snapshot file, for planning offline with --snapshot.
+#  Each view, version and repository is read once; --jobs of them at the same time.
+def cmd_snapshot(args):
+    if global_variables["multiple_organizations"]:
+        raise Exception("A snapshot is of one organization")
+    ensure_auth_session()
+
+
+    organization = current_organization()
+    views = list(hammer_pages("content-view", "list", "--organization-id", organization.id))
+    view_data = {}
+    def get_view(view):
+        view_data[view["Content View ID"]] = {
+            "list": view,
+            "info": get_content_view_info(view["Name"], view["Content View ID"]),
+            "versions": list(get_content_view_data(view["Name"], view["Content View ID"]))
+        }
+    failures = run_parallel(get_view, views, args.jobs, describe=lambda view: "read content view %s" % (view["Name"]), phase="read")
+    if failures:
+        raise Exception("Failed to read %d content views" % (len(failures)))
+    views = [view_data[view["Content View ID"]] for view in views]
+
+
+    # Composite view versions also get the component versions they were published with.
+    versions = {}
+    composite_version_ids = set([str(version["ID"]) for view in views if view["list"]["Composite"] for version in view["versions"]])
+    def get_version(version_id):
+        versions[version_id] = hammer("content-view", "version", "info", "--id", version_id, updates=False)
+        if version_id in composite_version_ids:
+            versions[version_id]["Components"] = list(hammer_pages("content-view", "version", "list", "--composite-version-id", version_id))
+    version_ids = [str(version["ID"]) for view in views for version in view["versions"]]
+    repositories = {}
+    def get_repository(repository_id):
+        repositories[repository_id] = hammer("repository", "info", "--id", repository_id, updates=False)
+    repository_ids = sorted(set([repository_id for view in views for repository_id in get_content_view_repository_ids(view["list"]["Name"], view["list"]["Content View ID"])]))
+    failures = run_parallel(get_version, version_ids, args.jobs, describe=lambda version_id: "read content view version %s" % (version_id), phase="read")
+    failures += run_parallel(get_repository, repository_ids, args.jobs, describe=lambda repository_id: "read repository %s" % (repository_id), phase="read")
+    if failures:
+        raise Exception("Failed to read %d content view versions and repositories" % (len(failures)))
+
+
+    snapshot = {
+        "format": SNAPSHOT_FORMAT,
+        "created": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC"),
+        "organization": {"ID": organization.id, "Name": organization.name},
+        "environments": get_lifecycle_environment_data(),
+        "views": views,
+        "versions": versions,
+        "repositories": repositories
+    }
+    temporary = "%s.%d.tmp%s" % (args.file, os.getpid(), ".gz" if args.file.endswith(".gz") else "")
+    with open_snapshot(temporary, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+    os.replace(temporary, args.file)
+    print("Snapshot of %d content views, %d versions and %d repositories written to %s" % (len(views), len(versions), len(repositories), args.file))
+
+
+# Resolve the --organization arguments (ids, names or labels) to organizations.
+#  Without any, organization 1 is used.
+def get_organizations(organization_names, all_organizations=False):
+    if not organization_names and not all_organizations:
+        return [global_variables["default_organization"]]
+    data = hammer("organization", "list", updates=False)
+    if all_organizations:
+        return [Organization(organization['ID'], organization['Name']) for organization in data]
+    # An organization given more than once (by id and by name, say) is run once.
+    matched = []
+    for name in organization_names:
+        matches = [organization for organization in data if name in [str(organization['ID']), organization['Name'], organization.get('Label')]]
+        if not matches:
+            raise Exception("%s does not match any organization" % (name))
+        if str(matches[0]['ID']) not in [str(organization['ID']) for organization in matched]:
+            matched.append(matches[0])
+    return [Organization(organization['ID'], organization['Name']) for organization in matched]
+
+
+# Run command for each organization, all organizations at the same time.
+#  Each organization has its own caches and summary; a failure in one
+#  organization does not stop the others.
+def run_for_organizations(command, args, organizations):
+    def run(organization):
+        organization_context.organization = organization
+        organization.history = DurationHistory(get_history_path(args.state_dir), record=not args.snapshot)
+        try:
+            with trace("command", command.__name__[len("cmd_"):] if command.__name__.startswith("cmd_") else command.__name__, organization=organization.name):
+                command(args)
+        finally:
+            organization.history.save()
+            verbose_print([1,2], "Read cache: %d hits, %d misses." % (organization.cache.hits, organization.cache.misses), file=sys.stderr)
+    if len(organizations) == 1:
+        try:
+            run(organizations[0])
+        finally:
+            organizations[0].summary.print()
+        return
+    global_variables["multiple_organizations"] = True
+    failures = run_parallel(run, organizations, len(organizations), describe=lambda organization: "organization %s" % (organization.name))
+    for organization in organizations:
+        print("Organization %s:" % (organization.name))
+        organization.summary.print()
+    if failures:
+        raise Exception("Failed for %d organizations: %s" % (len(failures), ", ".join([organization.name for (organization, e) in failures])))
+
+
+# Upper bounds of the hammer call duration histogram buckets, in seconds.
+HAMMER_DURATION_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800]
+
+
+# Summary categories counted as published, promoted or expired versions; all
+# "Not ..." categories count as skipped.
+SUMMARY_METRICS = {
+    "Published": "published",
+    "Promoted": "promoted",
+    "Expired": "expired"
+}
+
+
+def metric_labels(**labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{%s}" % (",".join(['%s="%s"' % (name, escape(value)) for (name, value) in sorted(labels.items())]))
+
+
+# Write the metrics of the run in the Prometheus text format, for the
+# node_exporter textfile collector (which reads files named *.prom).
+#  The file is replaced at once, so that the collector never sees half a file.
+def write_metrics(path, tracer, command, organizations, succeeded):
+    command = command.__name__[len("cmd_"):] if command.__name__.startswith("cmd_") else command.__name__
+    lines = []
+    def metric(name, kind, help, samples):
+        lines.append("# HELP contentview_updata_%s %s" % (name, help))
+        lines.append("# TYPE contentview_updata_%s %s" % (name, kind))
+        for (suffix, labels, value) in samples:
+            lines.append("contentview_updata_%s%s%s %s" % (name, suffix, metric_labels(**labels), repr(float(value)) if isinstance(value, float) else value))
+    with tracer.lock:
+        spans = list(tracer.spans)
+    metric("last_run_timestamp_seconds", "gauge", "When the run finished.", [("", {"command": command}, time.time())])
+    metric("last_run_success", "gauge", "Whether the run succeeded.", [("", {"command": command}, 1 if succeeded else 0)])
+    metric("command_duration_seconds", "gauge", "Duration of the command, per organization.",
+           [("", {"command": command, "organization": span["args"]["organization"]}, span["duration"]) for span in spans if span["cat"] == "command"])
+    phases = {}
+    for span in spans:
+        if span["cat"] == "step" and span["args"].get("phase"):
+            phase = phases.setdefault(span["args"]["phase"], [0, 0.0, 0])
+            phase[0] += 1
+            phase[1] += span["duration"]
+            phase[2] += 0 if span["args"]["outcome"] == "ok" else 1
+    metric("phase_steps", "gauge", "Number of steps of each phase.", [("", {"command": command, "phase": phase}, values[0]) for (phase, values) in sorted(phases.items())])
+    metric("phase_duration_seconds", "gauge", "Time spent in the steps of each phase, summed over parallel steps.", [("", {"command": command, "phase": phase}, values[1]) for (phase, values) in sorted(phases.items())])
+    metric("phase_failures", "gauge", "Number of failed steps of each phase.", [("", {"command": command, "phase": phase}, values[2]) for (phase, values) in sorted(phases.items())])
+    versions = []
+    for organization in organizations:
+        for (category, items) in sorted(organization.summary.items.items()):
+            if category in SUMMARY_METRICS:
+                versions.append(("", {"command": command, "organization": organization.name, "action": SUMMARY_METRICS[category], "reason": ""}, len(items)))
+            elif category.startswith("Not "):
+                versions.append(("", {"command": command, "organization": organization.name, "action": "skipped", "reason": category}, len(items)))
+    metric("versions", "gauge", "Content view versions published, promoted, expired or skipped, as in the run summary.", versions)
+    calls = {}
+    for span in spans:
+        if span["cat"] == "hammer":
+            call = calls.setdefault(span["name"], {"count": 0, "failures": 0, "sum": 0.0, "buckets": [0] * len(HAMMER_DURATION_BUCKETS)})
+            call["count"] += 1
+            call["failures"] += 0 if span["args"]["outcome"] == "ok" else 1
+            call["sum"] += span["duration"]
+            for (i, bound) in enumerate(HAMMER_DURATION_BUCKETS):
+                if span["duration"] <= bound:
+                    call["buckets"][i] += 1
+    metric("hammer_calls", "gauge", "Number of hammer commands run (or API calls made).", [("", {"command": command, "hammer_command": name}, call["count"]) for (name, call) in sorted(calls.items())])
+    metric("hammer_failures", "gauge", "Number of hammer commands which failed.", [("", {"command": command, "hammer_command": name}, call["failures"]) for (name, call) in sorted(calls.items())])
+    histogram = []
+    for (name, call) in sorted(calls.items()):
+        for (bound, count) in zip(HAMMER_DURATION_BUCKETS, call["buckets"]):
+            histogram.append(("_bucket", {"command": command, "hammer_command": name, "le": bound}, count))
+        histogram.append(("_bucket", {"command": command, "hammer_command": name, "le": "+Inf"}, call["count"]))
+        histogram.append(("_sum", {"command": command, "hammer_command": name}, call["sum"]))
+        histogram.append(("_count", {"command": command, "hammer_command": name}, call["count"]))
+    metric("hammer_duration_seconds", "histogram", "Duration of hammer commands.", histogram)
+    metric("cache_hits", "gauge", "Hammer results answered from the read cache.", [("", {"command": command, "organization": organization.name}, organization.cache.hits) for organization in organizations])
+    metric("cache_misses", "gauge", "Hammer results not in the read cache.", [("", {"command": command, "organization": organization.name}, organization.cache.misses) for organization in organizations])
+    temporary = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temporary, path)
 
 
 def main():
@@ -441,8 +2660,27 @@ Typical usage:
     parser.add_argument('--description', default=date_and_time, metavar="STRING", help='set comment added to update operations')
     parser.add_argument('--composite-view', metavar="NAME", action='append', dest="composite_view_names", help='only update/promote this composite view (multiple allowed)')
     parser.add_argument('--dry-run', action='store_true', help='stop before any action which changes existing data')
-    parser.add_argument('--verbose', '-v', action='count', help='give more information during operations')
+    parser.add_argument('--verbose', '-v', action='count', default=0, help='give more information during operations')
     parser.add_argument('--force-yum-metadata-regeneration', dest="force_regen", action='store_true', help='force metadata regeneration')
+    parser.add_argument('--sync-capsules', action='store_true', help='after promoting, sync the capsules with content from the environments promoted to, and wait for them')
+    parser.add_argument('--capsule-jobs', metavar="N", type=int, default=2, help='with --sync-capsules, sync at most N capsules at the same time (default 2)')
+    parser.add_argument('--organization', metavar="ORG", action='append', dest="organizations", help='work on this organization, by id, name or label (multiple allowed, default 1)')
+    parser.add_argument('--all-organizations', action='store_true', help='work on all organizations')
+    parser.add_argument('--jobs', '-j', metavar="N", type=int, default=2, help='run at most N operations (publishes, promotions, deletes, reads for snapshot and expire sizes) at the same time; the most with --adaptive (default 2)')
+    parser.add_argument('--async-tasks', action='store_true', help='do not keep a hammer process per running task; poll all running tasks together instead')
+    parser.add_argument('--poll-interval', metavar="SECONDS", type=float, default=5.0, help='how often to check running tasks with --async-tasks (default 5)')
+    parser.add_argument('--adaptive', action='store_true', help='run between --min-jobs and --jobs tasks at the same time, fewer when the server has many tasks queued')
+    parser.add_argument('--min-jobs', metavar="N", type=int, default=1, help='with --adaptive, never run fewer than N tasks at the same time (default 1)')
+    parser.add_argument('--backlog-high', metavar="N", type=int, default=20, help='with --adaptive, back off when more than N tasks are queued or running (default 20)')
+    parser.add_argument('--backlog-low', metavar="N", type=int, default=5, help='with --adaptive, run more tasks when fewer than N are queued or running (default 5)')
+    parser.add_argument('--backlog-interval', metavar="SECONDS", type=float, default=30.0, help='with --adaptive, count queued tasks every SECONDS (default 30)')
+    parser.add_argument('--state-dir', metavar="DIR", default="~/.contentview_updata", help='where to keep run journals and the history of durations (default ~/.contentview_updata)')
+    parser.add_argument('--server', metavar="URL", help='use the Foreman REST API at URL directly instead of running hammer')
+    parser.add_argument('--username', metavar="USER", default=os.environ.get("FOREMAN_USERNAME"), help='user for --server (default $FOREMAN_USERNAME; password from $FOREMAN_PASSWORD or prompt)')
+    parser.add_argument('--cacert', metavar="FILE", help='CA certificate for verifying --server')
+    parser.add_argument('--trace', metavar="FILE", help='write the timing of all operations to FILE (Chrome trace format) and show the slowest at the end')
+    parser.add_argument('--snapshot', metavar="FILE", help='work offline on a snapshot written by the snapshot command; changes are only planned and listed')
+    parser.add_argument('--metrics-file', metavar="FILE", help='write metrics of the run to FILE for the Prometheus node_exporter textfile collector (name it *.prom)')
 
 
     def cmd_help(args):
@@ -455,6 +2693,8 @@ Typical usage:
 
     parser_update = subparsers.add_parser('update', help='update content views')
     parser_update.add_argument('--promote-to', metavar="ENV", action='append', help='also promote the updates directly (multiple allowed)')
+    parser_update.add_argument('--resume', action='store_true', help='continue an interrupted update with the same --description, skipping completed steps')
+    parser_update.add_argument('--force-publish', action='store_true', help='publish (and promote) all views, even if their repositories or component versions have not changed')
     parser_update.set_defaults(func=cmd_update)
 
 
@@ -464,16 +2704,80 @@ Typical usage:
     parser_promote.set_defaults(func=cmd_promote)
 
 
+    parser_publish = subparsers.add_parser('publish', help='publish content views which are not composite views')
+    parser_publish.add_argument('names', metavar="NAME", nargs='+', help='publish the views with this name, or matching this pattern (like "RHEL*")')
+    parser_publish.add_argument('--timeout', metavar="SECONDS", type=float, help='count a publish as failed when it has not finished after SECONDS')
+    parser_publish.set_defaults(func=cmd_publish)
+
+
+    parser_watch = subparsers.add_parser('watch', help='publish component views when their repositories have been synced')
+    parser_watch.add_argument('--interval', metavar="SECONDS", type=float, default=60, help='check for finished repository syncs every SECONDS (default 60)')
+    parser_watch.add_argument('--debounce', metavar="SECONDS", type=float, default=300, help='publish a view when its repositories have not finished a sync for SECONDS (default 300)')
+    parser_watch.set_defaults(func=cmd_watch)
+
+
     parser_expire = subparsers.add_parser('expire', help='expire content view versions')
-    parser_expire.add_argument('--keep', metavar="INTEGER", default="12", required=True, help='keep at least the INTEGER latest versions in each ontent view')
+    parser_expire.add_argument('--keep', metavar="INTEGER", default="12", help='keep at least the INTEGER latest versions in each ontent view (default 12)')
+    parser_expire.add_argument('--max-age', metavar="DAYS", type=int, help='only expire versions older than DAYS (unless over a size limit)')
+    parser_expire.add_argument('--view-budget', metavar="SIZE", type=parse_size, help='expire the oldest versions while a view takes more than SIZE (like 200G)')
+    parser_expire.add_argument('--budget', metavar="SIZE", type=parse_size, help='expire the oldest versions while all views take more than SIZE')
+    parser_expire.add_argument('--package-size', metavar="SIZE", type=parse_size, default=parse_size("2M"), help='estimated size per package, when the server reports no size (default 2M)')
+    parser_expire.add_argument('--plan', action='store_true', help='only show what would be expired and how much space that frees')
     parser_expire.set_defaults(func=cmd_expire)
 
 
+    parser_snapshot = subparsers.add_parser('snapshot', help='save the content views, versions and environments, for planning offline with --snapshot')
+    parser_snapshot.add_argument('file', metavar="FILE", help='write the snapshot to FILE (compressed if it ends with .gz)')
+    parser_snapshot.set_defaults(func=cmd_snapshot)
+
+
     args = parser.parse_args()
     set_verbose(args.verbose)
     if args.dry_run:
         set_dry_run()
-    args.func(args)
+    if args.snapshot:
+        if args.server or args.dry_run or args.sync_capsules or args.func in [cmd_watch, cmd_snapshot]:
+            parser.error("--snapshot can not be combined with --server, --dry-run, --sync-capsules, watch or snapshot")
+        set_api(SnapshotAPI(args.snapshot))
+        if not args.organizations and not args.all_organizations:
+            args.organizations = [global_variables["api"].organization["ID"]]
+    if args.server:
+        if not args.username:
+            parser.error("--server requires --username or $FOREMAN_USERNAME")
+        password = os.environ.get("FOREMAN_PASSWORD")
+        if password is None:
+            password = getpass.getpass("Password for %s: " % (args.username))
+        set_api(ForemanAPI(args.server, args.username, password, cafile=args.cacert))
+    if args.async_tasks:
+        set_task_poller(TaskPoller(interval=args.poll_interval))
+    if args.adaptive:
+        set_limiter(AdaptiveLimiter(args.min_jobs, args.jobs, high=args.backlog_high, low=args.backlog_low, interval=args.backlog_interval))
+    if args.trace or args.metrics_file:
+        set_tracer(Tracer())
+    organizations = []
+    succeeded = False
+    try:
+        organizations = get_organizations(args.organizations, args.all_organizations)
+        run_for_organizations(args.func, args, organizations)
+        succeeded = True
+    finally:
+        # Errors here must not hide the error of the run.
+        if args.trace:
+            try:
+                global_variables["tracer"].write(args.trace)
+                global_variables["tracer"].print_slowest()
+            except Exception as e:
+                print("Failed to write the trace to %s: %s" % (args.trace, e), file=sys.stderr)
+        if args.metrics_file:
+            try:
+                write_metrics(args.metrics_file, global_variables["tracer"], args.func, organizations, succeeded)
+            except Exception as e:
+                print("Failed to write metrics to %s: %s" % (args.metrics_file, e), file=sys.stderr)
+        if args.snapshot:
+            plan = global_variables["api"].plan
+            print("Planned changes against snapshot %s (%d):" % (args.snapshot, len(plan)))
+            for commandline in plan:
+                print("  %s" % (commandline))
 
 
 main()
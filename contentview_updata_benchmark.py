@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# The MIT License (MIT)
+#
+# Copyright (C) 2018 Kungliga Tekniska högskolan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+# Measure how contentview_updata.py scales with the size of the organization.
+#  Runs update, promote and expire against the fake server of
+#  contentview_updata_fake.py, which answers each call after a latency and
+#  keeps tasks running for a while, for organizations with more and more
+#  composite views. Reports wall-clock time, calls and peak memory of each
+#  run. With --output the results are also saved as JSON, to compare releases
+#  (use --script to run another copy of contentview_updata.py).
+
+
+import sys
+import os
+import json
+import time
+import subprocess
+import tempfile
+import argparse
+
+import contentview_updata_fake
+import contentview_updata_budget
+
+
+# (name, arguments) of the commands measured, on a fresh organization each.
+COMMANDS = [
+    ("update", lambda size: ["update", "--promote-to", "Env1"]),
+    ("promote", lambda size: ["promote", "--from", "Env2", "--to", "Env3"]),
+    ("expire", lambda size: ["expire", "--keep", "2"])
+]
+
+
+# Run the script with arguments and wait for it.
+#  Returns (returncode, seconds, peak resident memory in bytes).
+def run_measured(arguments, environment):
+    start = time.monotonic()
+    process = subprocess.Popen(arguments, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=environment)
+    (pid, status, rusage) = os.wait4(process.pid, 0)
+    seconds = time.monotonic() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    # ru_maxrss is in kilobytes on Linux.
+    return (process.returncode, seconds, rusage.ru_maxrss * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure contentview_updata.py against a fake Foreman server with synthetic organizations.')
+    parser.add_argument('--composites', metavar="N,...", default="10,100,1000", help='sizes of the organizations, in composite views (default 10,100,1000)')
+    parser.add_argument('--fanout', metavar="N", type=int, default=3, help='component views per composite view (default 3)')
+    parser.add_argument('--depth', metavar="N", type=int, default=4, help='lifecycle environments after Library (default 4)')
+    parser.add_argument('--versions', metavar="N", type=int, default=3, help='versions of each view (default 3)')
+    parser.add_argument('--changed', metavar="N", type=int, default=1, help='component views with new repository content (default 1)')
+    parser.add_argument('--latency', metavar="SECONDS", type=float, default=0.01, help='answer each call after SECONDS (default 0.01)')
+    parser.add_argument('--task-duration', metavar="SECONDS", type=float, default=0.0, help='keep tasks running for SECONDS (default 0)')
+    parser.add_argument('--command', metavar="NAME", action='append', dest="commands", choices=[name for (name, arguments) in COMMANDS], help='only measure this command (multiple allowed)')
+    parser.add_argument('--script', metavar="FILE", default=contentview_updata_budget.SCRIPT, help='the contentview_updata.py to measure (default the one next to this script)')
+    parser.add_argument('--output', metavar="FILE", help='also write the results to FILE as JSON')
+    parser.add_argument('options', metavar="OPTION", nargs='*', help='more options for contentview_updata.py, after --, like -- --jobs 8 --async-tasks')
+    args = parser.parse_args()
+
+
+    results = []
+    print("%-8s %10s %6s %6s %10s %8s %8s %10s %s" % ("Command", "Composites", "Views", "Depth", "Seconds", "Reads", "Writes", "Peak MB", "Status"))
+    for composites in [int(composites) for composites in args.composites.split(",")]:
+        for (name, arguments) in COMMANDS:
+            if args.commands and name not in args.commands:
+                continue
+            data = contentview_updata_fake.generate_organization(composites=composites, fanout=args.fanout, depth=args.depth, versions=args.versions, changed=args.changed)
+            size = contentview_updata_budget.organization_size(data)
+            server = contentview_updata_fake.start_server(data, latency=args.latency, task_duration=args.task_duration)
+            try:
+                # A home directory of its own, for the state kept in ~/.contentview_updata.
+                with tempfile.TemporaryDirectory() as home:
+                    environment = dict(os.environ, HOME=home, FOREMAN_USERNAME="admin", FOREMAN_PASSWORD="secret")
+                    (returncode, seconds, peak_memory) = run_measured([sys.executable, args.script, "--server", server.url] + args.options + arguments(size), environment)
+                with server.foreman.lock:
+                    calls = list(server.foreman.calls)
+            finally:
+                server.shutdown()
+                server.server_close()
+            reads = len([call for call in calls if call[0] == "GET"])
+            result = {
+                "command": name,
+                "composites": composites,
+                "views": size["views"],
+                "depth": size["depth"],
+                "seconds": round(seconds, 3),
+                "reads": reads,
+                "writes": len(calls) - reads,
+                "peak_memory": peak_memory,
+                "returncode": returncode
+            }
+            results.append(result)
+            print("%-8s %10d %6d %6d %10.2f %8d %8d %10.1f %s" % (name, composites, size["views"], size["depth"], seconds, result["reads"], result["writes"], peak_memory / 1048576.0, "ok" if returncode == 0 else "exit status %d" % (returncode)), flush=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "script": args.script,
+                "options": args.options,
+                "latency": args.latency,
+                "task_duration": args.task_duration,
+                "fanout": args.fanout,
+                "results": results
+            }, f, indent=2)
+    if [result for result in results if result["returncode"] != 0]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# The MIT License (MIT)
+#
+# Copyright (C) 2018 Kungliga Tekniska högskolan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+# Check how many API calls contentview_updata.py makes.
+#  Runs update, promote and expire against the fake server of
+#  contentview_updata_fake.py, for organizations of several sizes, and compares
+#  the calls with a budget linear in the size of the organization. Exits with
+#  status 1 if any run fails or is over its budget, so that a change making
+#  calls per view and environment instead of per view is noticed.
+
+
+import sys
+import os
+import re
+import subprocess
+import tempfile
+import argparse
+
+import contentview_updata_fake
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "contentview_updata.py")
+
+
+# Organization sizes, as arguments to generate_organization.
+SIZES = [
+    {"composites": 3, "fanout": 2, "depth": 4},
+    {"composites": 10, "fanout": 3, "depth": 4},
+    {"composites": 30, "fanout": 3, "depth": 8}
+]
+
+
+# (name, arguments, budget) for each command checked.
+#  Both get the size of the organization (views, composites, components,
+#  versions and depth). The budget returns the most calls allowed, as
+#  (reads, writes). Writes are a publish per component view, a component
+#  update and a publish per composite view, and a promotion per composite view
+#  and environment; they necessarily grow with the environments a view is
+#  promoted through, reads must not. update reads the versions of each
+#  composite view it does not re-pin and the components of its latest version,
+#  to check that it was published; expire reads the components of the
+#  composite view versions it keeps, about one per composite view.
+COMMANDS = [
+    ("update",
+     lambda size: ["update", "--promote-to", "Env2"],
+     lambda size: (15 + 3 * size["views"] + 2 * size["composites"], size["components"] + 2 * size["composites"] + 2 * size["composites"])),
+    ("update all",
+     lambda size: ["update", "--force-publish", "--promote-to", "Env%d" % (size["depth"])],
+     lambda size: (15 + 3 * size["views"], size["components"] + 2 * size["composites"] + size["depth"] * size["composites"])),
+    ("promote",
+     lambda size: ["promote", "--from", "Env2", "--to", "Env3"],
+     lambda size: (10 + 2 * size["composites"], size["composites"])),
+    ("expire",
+     lambda size: ["expire", "--keep", "1"],
+     lambda size: (10 + 2 * size["views"] + size["composites"], size["versions"])),
+    ("expire plan",
+     lambda size: ["expire", "--keep", "1", "--plan"],
+     lambda size: (10 + 2 * size["views"] + size["composites"] + size["versions"], 0))
+]
+
+
+def organization_size(data):
+    composites = len([view for view in data["content_views"] if view["composite"]])
+    return {
+        "views": len(data["content_views"]),
+        "composites": composites,
+        "components": len(data["content_views"]) - composites,
+        "versions": len(data["versions"]),
+        "depth": len(data["environments"]) - 1
+    }
+
+
+# Calls grouped by method and path, with ids replaced by ":id".
+def call_counts(calls):
+    counts = {}
+    for (method, path, query) in calls:
+        key = "%s %s" % (method, re.sub(r"/[0-9a-f-]*[0-9][0-9a-f-]*(?=/|$)", "/:id", path))
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+# Run one command against a fresh fake server.
+#  Returns (returncode, standard error, calls).
+def run_command(data, arguments, jobs):
+    server = contentview_updata_fake.start_server(data)
+    try:
+        # A home directory of its own, for the state kept in ~/.contentview_updata.
+        with tempfile.TemporaryDirectory() as home:
+            environment = dict(os.environ, HOME=home, FOREMAN_USERNAME="admin", FOREMAN_PASSWORD="secret")
+            completed = subprocess.run([sys.executable, SCRIPT, "--server", server.url, "--jobs", str(jobs)] + arguments, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=environment)
+        with server.foreman.lock:
+            calls = list(server.foreman.calls)
+        return (completed.returncode, completed.stderr.decode("utf8", "replace"), calls)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that contentview_updata.py stays within its API call budgets.')
+    parser.add_argument('--jobs', '-j', metavar="N", type=int, default=1, help='pass --jobs N to contentview_updata.py (default 1, which gives repeatable counts)')
+    parser.add_argument('--verbose', '-v', action='store_true', help='show the calls by kind for every run, not only for runs over budget')
+    args = parser.parse_args()
+
+
+    over_budget = 0
+    print("%-12s %6s %6s %14s %14s" % ("Command", "Views", "Depth", "Reads/budget", "Writes/budget"))
+    for size_arguments in SIZES:
+        for (name, arguments, budget) in COMMANDS:
+            data = contentview_updata_fake.generate_organization(**size_arguments)
+            size = organization_size(data)
+            (returncode, errors, calls) = run_command(data, arguments(size), args.jobs)
+            reads = len([call for call in calls if call[0] == "GET"])
+            writes = len(calls) - reads
+            (read_budget, write_budget) = budget(size)
+            failed = returncode != 0 or reads > read_budget or writes > write_budget
+            print("%-12s %6d %6d %14s %14s%s" % (name, size["views"], size["depth"], "%d/%d" % (reads, read_budget), "%d/%d" % (writes, write_budget), "  FAILED (exit status %d)" % (returncode) if returncode != 0 else "  OVER BUDGET" if failed else ""))
+            if failed:
+                over_budget += 1
+                if returncode != 0:
+                    print(errors, file=sys.stderr)
+            if failed or args.verbose:
+                for (key, count) in sorted(call_counts(calls).items(), key=lambda item: -item[1]):
+                    print("    %6d %s" % (count, key))
+    if over_budget:
+        print("%d runs failed or were over budget" % (over_budget), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+# The MIT License (MIT)
+#
+# Copyright (C) 2018 Kungliga Tekniska högskolan
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+# Fake Foreman/Katello server for trying out contentview_updata.py --server.
+#  Serves a synthetic organization over the parts of the REST API which
+#  contentview_updata.py uses, and records every call. GET /__calls returns
+#  the recorded calls, POST /__reset forgets them.
+
+
+import sys
+import json
+import re
+import threading
+import time
+import uuid
+import datetime
+import argparse
+import urllib.parse
+import http.server
+import socketserver
+
+
+def now():
+    return timestamp(time.time())
+
+
+def timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+
+
+# A synthetic organization, in the form served by FakeForeman.
+#  There are components component views, each with one repository, and
+#  composites composite views of fanout components each. Environments form
+#  one path from Library, depth environments long. Each view has versions
+#  versions; the latest is in Library, and for composite views also in the
+#  rest of the path up to promoted environments; older composite view versions
+#  have the older component versions. The repositories of the first
+#  changed component views have new content. Besides the server's own smart
+#  proxy (without content) there are capsules capsules, each with Library and
+#  one other environment, from the last one backwards.
+def generate_organization(composites=3, components=None, fanout=2, depth=4, versions=3, promoted=2, changed=1, capsules=2):
+    if components is None:
+        components = max(fanout, (composites * fanout + 1) // 2)
+    organization = {"id": 1, "name": "Default Organization", "label": "Default_Organization"}
+    environments = [{"id": 1, "name": "Library", "prior_id": None}]
+    for i in range(depth):
+        environments.append({"id": i + 2, "name": "Env%d" % (i + 1), "prior_id": i + 1})
+    content_views = []
+    content_view_versions = []
+    repositories = []
+    def add_versions(view, environment_ids, component_ids=()):
+        for k in range(versions):
+            content_view_versions.append({
+                "id": len(content_view_versions) + 1,
+                "content_view_id": view["id"],
+                "version": "%d.0" % (k + 1),
+                "environment_ids": environment_ids if k == versions - 1 else [],
+                "created_at": "2000-01-01 00:00:00 UTC",
+                "package_count": 100,
+                "component_ids": [component_id - (versions - 1 - k) for component_id in component_ids]
+            })
+        return content_view_versions[-1]["id"]
+    latest = []
+    for c in range(components):
+        repository = {"id": 1000 + c, "name": "repo-%d" % (c), "last_sync": "2100-01-01 00:00:00 UTC" if c < changed else "1999-01-01 00:00:00 UTC"}
+        repositories.append(repository)
+        view = {"id": 1000 + c, "name": "component-%d" % (c), "composite": False, "repository_ids": [repository["id"]], "component_ids": []}
+        content_views.append(view)
+        latest.append(add_versions(view, [1]))
+    for c in range(composites):
+        component_ids = [latest[(c + j) % components] for j in range(fanout)]
+        view = {"id": 100000 + c, "name": "composite-%d" % (c), "composite": True, "repository_ids": [], "component_ids": component_ids}
+        content_views.append(view)
+        add_versions(view, [environment["id"] for environment in environments[0:promoted + 1]], component_ids)
+    capsule_data = [{"id": 1, "name": "foreman.example.com", "content": False, "environment_ids": []}]
+    for c in range(capsules):
+        capsule_data.append({"id": c + 2, "name": "capsule-%d.example.com" % (c), "content": True, "environment_ids": [1, environments[-1 - c % max(1, depth)]["id"]]})
+    return {
+        "organizations": [organization],
+        "capsules": capsule_data,
+        "environments": [dict(environment, organization_id=organization["id"]) for environment in environments],
+        "content_views": [dict(view, organization_id=organization["id"]) for view in content_views],
+        "versions": content_view_versions,
+        "repositories": repositories
+    }
+
+
+def paginate(items, query):
+    page = int(query.get("page", 1))
+    per_page = int(query.get("per_page", 20))
+    return {"total": len(items), "subtotal": len(items), "page": page, "per_page": per_page, "results": items[(page - 1) * per_page:page * per_page]}
+
+
+# The state of the fake server: the organization, its tasks and the calls made.
+#  Each call sleeps latency seconds first. Tasks stay running for
+#  task_duration seconds, and take effect when they are first seen stopped.
+class FakeForeman:
+    def __init__(self, data, latency=0.0, task_duration=0.0):
+        self.latency = latency
+        self.task_duration = task_duration
+        self.organizations = dict((organization["id"], organization) for organization in data["organizations"])
+        self.environments = dict((environment["id"], environment) for environment in data["environments"])
+        self.views = dict((view["id"], view) for view in data["content_views"])
+        self.versions = dict((version["id"], version) for version in data["versions"])
+        self.view_versions = dict((view_id, []) for view_id in self.views)
+        for version in data["versions"]:
+            self.view_versions[version["content_view_id"]].append(version["id"])
+        self.repositories = dict((repository["id"], repository) for repository in data["repositories"])
+        self.capsules = dict((capsule["id"], capsule) for capsule in data.get("capsules", []))
+        self.next_version_id = max(list(self.versions) + [0]) + 1
+        self.tasks = {}
+        self.calls = []
+        self.lock = threading.RLock()
+
+
+    def environment_json(self, environment):
+        prior = self.environments.get(environment["prior_id"])
+        return {"id": environment["id"], "name": environment["name"], "label": environment["name"], "prior": {"id": prior["id"], "name": prior["name"]} if prior else None}
+
+
+    def version_json(self, version):
+        view = self.views[version["content_view_id"]]
+        return {
+            "id": version["id"],
+            "name": "%s %s" % (view["name"], version["version"]),
+            "version": version["version"],
+            "content_view_id": view["id"],
+            "content_view": {"id": view["id"], "name": view["name"]},
+            "description": version.get("description"),
+            "created_at": version["created_at"],
+            "package_count": version.get("package_count", 0),
+            "environments": [{"id": environment_id, "name": self.environments[environment_id]["name"]} for environment_id in sorted(version["environment_ids"])]
+        }
+
+
+    def view_json(self, view):
+        return {
+            "id": view["id"],
+            "name": view["name"],
+            "label": view["name"],
+            "composite": view["composite"],
+            "description": view.get("description"),
+            "components": [self.version_json(self.versions[version_id]) for version_id in view["component_ids"]],
+            "repositories": [{"id": repository_id, "name": self.repositories[repository_id]["name"], "label": self.repositories[repository_id]["name"]} for repository_id in view["repository_ids"]],
+            "repository_ids": view["repository_ids"],
+            "last_published": None
+        }
+
+
+    def repository_json(self, repository):
+        return {"id": repository["id"], "name": repository["name"], "label": repository["name"], "updated_at": repository["last_sync"], "content_last_updated": repository["last_sync"], "last_sync": {"result": "success", "ended_at": repository["last_sync"]}}
+
+
+    def capsule_json(self, capsule):
+        return {"id": capsule["id"], "name": capsule["name"], "url": "https://%s:9090" % (capsule["name"]), "features": [{"name": "Pulp Node"}] if capsule["content"] else [{"name": "Pulp"}]}
+
+
+    def start_task(self, label, effect=None, input=None):
+        task = {"id": str(uuid.uuid4()), "label": label, "started": time.time(), "effect": effect, "input": input, "result": "success", "errors": []}
+        self.tasks[task["id"]] = task
+        return self.task_json(task)
+
+
+    def task_json(self, task):
+        done = time.time() - task["started"] >= self.task_duration
+        if done and task["effect"] is not None:
+            (effect, task["effect"]) = (task["effect"], None)
+            try:
+                effect()
+            except ValueError as e:
+                task["result"] = "error"
+                task["errors"].append(str(e))
+        return {
+            "id": task["id"],
+            "label": task["label"],
+            "action": task["label"],
+            "input": task["input"],
+            "state": "stopped" if done else "running",
+            "result": task["result"] if done else "pending",
+            "started_at": timestamp(task["started"]),
+            "ended_at": timestamp(task["started"] + self.task_duration) if done else None,
+            "humanized": {"errors": task["errors"]}
+        }
+
+
+    # Move an environment to one version of a view.
+    def set_environment(self, view_id, version_id, environment_id):
+        for other_id in self.view_versions[view_id]:
+            other = self.versions[other_id]
+            other["environment_ids"] = [other_environment_id for other_environment_id in other["environment_ids"] if other_environment_id != environment_id]
+        self.versions[version_id]["environment_ids"].append(environment_id)
+
+
+    def publish(self, view, description):
+        version_id = self.next_version_id
+        self.next_version_id += 1
+        major = max([int(self.versions[other_id]["version"].split(".")[0]) for other_id in self.view_versions[view["id"]]] + [0]) + 1
+        self.versions[version_id] = {"id": version_id, "content_view_id": view["id"], "version": "%d.0" % (major), "environment_ids": [], "created_at": now(), "description": description, "package_count": 100, "component_ids": list(view["component_ids"])}
+        self.view_versions[view["id"]].append(version_id)
+        library = [environment["id"] for environment in self.environments.values() if environment["organization_id"] == view["organization_id"] and environment["prior_id"] is None][0]
+        self.set_environment(view["id"], version_id, library)
+
+
+    def promote(self, version, environment):
+        if environment["prior_id"] not in version["environment_ids"]:
+            raise ValueError("Version %s is not in the prior environment of %s" % (version["version"], environment["name"]))
+        self.set_environment(version["content_view_id"], version["id"], environment["id"])
+
+
+    def delete(self, version):
+        if version["environment_ids"]:
+            raise ValueError("Version %s is in a lifecycle environment" % (version["version"]))
+        for view in self.views.values():
+            if version["id"] in view["component_ids"]:
+                raise ValueError("Version %s is a component of %s" % (version["version"], view["name"]))
+        for other in self.versions.values():
+            if version["id"] in other.get("component_ids", []):
+                raise ValueError("Version %s is a component of version %s of %s" % (version["version"], other["version"], self.views[other["content_view_id"]]["name"]))
+        del self.versions[version["id"]]
+        self.view_versions[version["content_view_id"]].remove(version["id"])
+
+
+    # Answer a call; returns (status, data).
+    #  Unknown ids raise KeyError, invalid requests ValueError.
+    def route(self, method, path, query, body):
+        if path == "/api/current_user":
+            return (200, {"login": "admin"})
+        if path == "/katello/api/organizations":
+            return (200, paginate(list(self.organizations.values()), query))
+        match = re.match(r"^/katello/api/organizations/(\d+)/environments$", path)
+        if match:
+            return (200, paginate([self.environment_json(environment) for environment in sorted(self.environments.values(), key=lambda environment: environment["id"]) if environment["organization_id"] == int(match.group(1))], query))
+        if path == "/katello/api/content_views":
+            views = [view for view in sorted(self.views.values(), key=lambda view: view["id"]) if view["organization_id"] == int(query["organization_id"])]
+            if "composite" in query:
+                views = [view for view in views if view["composite"] == (query["composite"] == "true")]
+            if "name" in query:
+                views = [view for view in views if view["name"] == query["name"]]
+            return (200, paginate([self.view_json(view) for view in views], query))
+        match = re.match(r"^/katello/api/content_views/(\d+)(/publish)?$", path)
+        if match:
+            view = self.views[int(match.group(1))]
+            if match.group(2):
+                return (202, self.start_task("Actions::Katello::ContentView::Publish", lambda: self.publish(view, body.get("description"))))
+            if method == "PUT":
+                for version_id in body.get("component_ids", []):
+                    self.versions[int(version_id)]
+                view["component_ids"] = [int(version_id) for version_id in body.get("component_ids", [])]
+            return (200, self.view_json(view))
+        if path == "/katello/api/content_view_versions":
+            if "composite_version_id" in query:
+                version_ids = sorted(self.versions[int(query["composite_version_id"])].get("component_ids", []), reverse=True)
+            else:
+                version_ids = sorted(self.view_versions[int(query["content_view_id"])], reverse=True)
+            return (200, paginate([self.version_json(self.versions[version_id]) for version_id in version_ids], query))
+        match = re.match(r"^/katello/api/content_view_versions/(\d+)(/promote)?$", path)
+        if match:
+            version = self.versions[int(match.group(1))]
+            if match.group(2):
+                environment = self.environments[int(body["environment_ids"][0])]
+                return (202, self.start_task("Actions::Katello::ContentView::Promote", lambda: self.promote(version, environment)))
+            if method == "DELETE":
+                return (202, self.start_task("Actions::Katello::ContentViewVersion::Destroy", lambda: self.delete(version)))
+            return (200, self.version_json(version))
+        match = re.match(r"^/katello/api/repositories/(\d+)(/sync)?$", path)
+        if match:
+            repository = self.repositories[int(match.group(1))]
+            if match.group(2):
+                def sync():
+                    repository["last_sync"] = now()
+                return (202, self.start_task("Actions::Katello::Repository::Sync", sync, input={"repository": {"id": repository["id"], "name": repository["name"]}}))
+            return (200, self.repository_json(repository))
+        if path == "/katello/api/capsules":
+            return (200, paginate([self.capsule_json(capsule) for capsule in sorted(self.capsules.values(), key=lambda capsule: capsule["id"])], query))
+        match = re.match(r"^/katello/api/capsules/(\d+)/content/(lifecycle_environments|sync)$", path)
+        if match:
+            capsule = self.capsules[int(match.group(1))]
+            if not capsule["content"]:
+                raise ValueError("%s is not a capsule with content" % (capsule["name"]))
+            if match.group(2) == "sync":
+                if body.get("environment_id") is not None and int(body["environment_id"]) not in capsule["environment_ids"]:
+                    raise ValueError("Lifecycle environment %s is not attached to %s" % (body["environment_id"], capsule["name"]))
+                return (202, self.start_task("Actions::Katello::CapsuleContent::Sync", input={"smart_proxy": {"id": capsule["id"], "name": capsule["name"]}}))
+            environments = [self.environments[environment_id] for environment_id in capsule["environment_ids"]]
+            return (200, paginate([dict(self.environment_json(environment), organization=self.organizations[environment["organization_id"]]) for environment in environments], query))
+        if path == "/foreman_tasks/api/tasks":
+            search = query.get("search", "")
+            task_ids = re.findall(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", search)
+            tasks = [self.task_json(self.tasks[task_id]) for task_id in task_ids if task_id in self.tasks] if task_ids else [self.task_json(task) for task in self.tasks.values()]
+            match = re.search(r"label = (\S+)", search)
+            if match:
+                tasks = [task for task in tasks if task["label"] == match.group(1)]
+            if "state ^ (planning, planned, running)" in search:
+                tasks = [task for task in tasks if task["state"] == "running"]
+            if "state = stopped" in search:
+                tasks = [task for task in tasks if task["state"] == "stopped"]
+            match = re.search(r'ended_at >= "([^"]*)"', search)
+            if match:
+                tasks = [task for task in tasks if task["ended_at"] is not None and task["ended_at"] >= match.group(1)]
+            # Newest first, like foreman.
+            tasks.reverse()
+            return (200, paginate(tasks, query))
+        match = re.match(r"^/foreman_tasks/api/tasks/([-0-9a-f]+)$", path)
+        if match:
+            return (200, self.task_json(self.tasks[match.group(1)]))
+        return (404, {"error": {"message": "No route for %s %s" % (method, path)}})
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class FakeForemanHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def send(self, status, data):
+        content = json.dumps(data).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+    def handle_request(self, method):
+        foreman = self.server.foreman
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length).decode("utf8")) if length else {}
+        if url.path == "/__calls":
+            with foreman.lock:
+                return self.send(200, foreman.calls)
+        if url.path == "/__reset":
+            with foreman.lock:
+                foreman.calls = []
+            return self.send(200, {})
+        if foreman.latency:
+            time.sleep(foreman.latency)
+        with foreman.lock:
+            foreman.calls.append([method, url.path, query])
+            try:
+                (status, data) = foreman.route(method, url.path, query, body)
+            except KeyError as e:
+                (status, data) = (404, {"error": {"message": "Not found: %s" % (e)}})
+            except ValueError as e:
+                (status, data) = (422, {"error": {"message": str(e)}})
+        self.send(status, data)
+
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+# Serve the organization data in a background thread.
+#  Returns the server; its URL is server.url, server.foreman has the state.
+def start_server(data, port=0, latency=0.0, task_duration=0.0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeForemanHandler)
+    server.foreman = FakeForeman(data, latency=latency, task_duration=task_duration)
+    server.url = "http://%s:%d" % server.server_address
+    threading.Thread(target=server.serve_forever, name="fake-foreman", daemon=True).start()
+    return server
+
+
+def add_organization_arguments(parser):
+    parser.add_argument('--composites', metavar="N", type=int, default=3, help='number of composite views (default 3)')
+    parser.add_argument('--components', metavar="N", type=int, help='number of component views (default composites times fanout, halved)')
+    parser.add_argument('--fanout', metavar="N", type=int, default=2, help='component views per composite view (default 2)')
+    parser.add_argument('--depth', metavar="N", type=int, default=4, help='lifecycle environments after Library (default 4)')
+    parser.add_argument('--versions', metavar="N", type=int, default=3, help='versions of each view (default 3)')
+    parser.add_argument('--promoted', metavar="N", type=int, default=2, help='environments after Library with the latest composite versions (default 2)')
+    parser.add_argument('--changed', metavar="N", type=int, default=1, help='component views with new repository content (default 1)')
+    parser.add_argument('--capsules', metavar="N", type=int, default=2, help='capsules with content (default 2)')
+
+
+def generate_organization_from_arguments(args):
+    return generate_organization(composites=args.composites, components=args.components, fanout=args.fanout, depth=args.depth, versions=args.versions, promoted=args.promoted, changed=args.changed, capsules=args.capsules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic organization like Foreman/Katello does, for contentview_updata.py --server.')
+    parser.add_argument('--port', metavar="PORT", type=int, default=8765, help='listen on PORT (default 8765)')
+    parser.add_argument('--latency', metavar="SECONDS", type=float, default=0.0, help='answer each call after SECONDS (default 0)')
+    parser.add_argument('--task-duration', metavar="SECONDS", type=float, default=0.0, help='keep tasks running for SECONDS (default 0)')
+    add_organization_arguments(parser)
+    args = parser.parse_args()
+    server = start_server(generate_organization_from_arguments(args), port=args.port, latency=args.latency, task_duration=args.task_duration)
+    print("Serving on %s" % (server.url), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()